@@ -1,25 +1,190 @@
-from flask import Flask, render_template, request, send_file, jsonify
-import pandas as pd
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+from flask import Flask, render_template, request, send_file, jsonify, Response, url_for, g
+from werkzeug.utils import secure_filename
+import reportlab
 from reportlab.lib.pagesizes import A4, landscape
-from reportlab.pdfgen import canvas
-from reportlab.lib import colors
-from num2words import num2words
+import importlib
+import multiprocessing
 import os
-from PIL import Image
 import zipfile
+import io
 from datetime import datetime
 import json
+import cProfile
+import gzip
+import hashlib
+import hmac
+import logging
+import pstats
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import sqlite3
+import uuid
+import warnings
+from collections import Counter, deque
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+
+class _LazyModule:
+    """A heavy dependency, imported the first time one of its attributes is used.
+
+    The import rebinds the module-level name to the real module, so only
+    the first lookup goes through here.
+    """
+
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+
+# pandas, openpyxl, ReportLab, Pillow and num2words take over a second to
+# import; deferring them keeps light endpoints such as /api/companies free of
+# that cost.  warm_up() loads them all ahead of time.
+pd = _LazyModule("pandas", "pd")
+np = _LazyModule("numpy", "np")
+openpyxl = _LazyModule("openpyxl", "openpyxl")
+xl_cell = _LazyModule("openpyxl.cell.cell", "xl_cell")
+canvas = _LazyModule("reportlab.pdfgen.canvas", "canvas")
+colors = _LazyModule("reportlab.lib.colors", "colors")
+pdfmetrics = _LazyModule("reportlab.pdfbase.pdfmetrics", "pdfmetrics")
+rl_utils = _LazyModule("reportlab.lib.utils", "rl_utils")
+Image = _LazyModule("PIL.Image", "Image")
+num2words = _LazyModule("num2words", "num2words")
 
 app = Flask(__name__)
 
 UPLOAD_FOLDER = "uploads"
 OUTPUT_FOLDER = "output"
-HISTORY_FILE = "history.json"
+HISTORY_FILE = "history.json"          # legacy store, imported into SQLite once
+DB_PATH = os.environ.get("PORTAL_DB", "portal.db")
+JOBS_FOLDER = os.path.join(OUTPUT_FOLDER, "jobs")
+PARSE_CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, "parsed")
+PROFILES_FOLDER = os.path.join(OUTPUT_FOLDER, "profiles")
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+os.makedirs(JOBS_FOLDER, exist_ok=True)
+os.makedirs(PARSE_CACHE_FOLDER, exist_ok=True)
+os.makedirs(PROFILES_FOLDER, exist_ok=True)
 os.makedirs("static/logos", exist_ok=True)
 
+# Parallel PDF rendering – bills are farmed out to a process pool once an
+# upload has at least PDF_PARALLEL_MIN_BILLS freight bills.
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", os.cpu_count() or 1))
+PDF_PARALLEL_MIN_BILLS = int(os.environ.get("PDF_PARALLEL_MIN_BILLS", 8))
+# Seconds to wait for one bill from the pool before the request fails.
+PDF_RENDER_TIMEOUT = float(os.environ.get("PDF_RENDER_TIMEOUT", 120))
+
+# PDFs are rendered into memory and zipped straight from there; writing each
+# bill to OUTPUT_FOLDER (needed by /api/bills and the history chips) can be
+# switched off with PERSIST_PDFS=0.
+PERSIST_PDFS = os.environ.get("PERSIST_PDFS", "1") == "1"
+
+# Background generation jobs (POST /api/jobs) run on this many threads per
+# worker process.  Jobs are queued in SQLite, so any worker can run them and
+# report on them; idle threads look for queued jobs every JOB_POLL_INTERVAL
+# seconds.  A running job whose worker has not been heard from for
+# JOB_STALE_SECONDS (recycled, killed, redeployed) is queued again, up to
+# JOB_MAX_ATTEMPTS runs in all.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 2))
+JOB_STALE_SECONDS = float(os.environ.get("JOB_STALE_SECONDS", 120))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+
+# POST /api/batch works on this many workbooks at once (bills still render
+# in the shared PDF pool) and accepts at most BATCH_MAX_WORKBOOKS of them.
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", 4))
+BATCH_MAX_WORKBOOKS = int(os.environ.get("BATCH_MAX_WORKBOOKS", 50))
+# Byte limits, checked before anything is read into memory: a workbook
+# (uploaded or inside a ZIP) may unpack to BATCH_MAX_WORKBOOK_MB and a whole
+# batch to BATCH_MAX_TOTAL_MB.  No request body may exceed MAX_UPLOAD_MB.
+BATCH_MAX_WORKBOOK_MB = int(os.environ.get("BATCH_MAX_WORKBOOK_MB", 25))
+BATCH_MAX_TOTAL_MB = int(os.environ.get("BATCH_MAX_TOTAL_MB", 200))
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", 100))
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
+
+# Company logos are decoded once per process and downsampled to this
+# resolution at their printed size.
+LOGO_DPI = int(os.environ.get("LOGO_DPI", 200))
+
+# Entries kept in the wrapped-line cache used by wrap_text_lines.
+WRAP_CACHE_SIZE = int(os.environ.get("WRAP_CACHE_SIZE", 4096))
+
+# Parsed sheets are cached on disk by content hash so /preview's work is
+# reused when the same file is generated; least recently used entries are
+# dropped once the cache exceeds PARSE_CACHE_MAX_MB.
+PARSE_CACHE_MAX_MB = int(os.environ.get("PARSE_CACHE_MAX_MB", 256))
+
+# Storage janitor: files in output/ unused (not generated or downloaded) for
+# RETENTION_DAYS are removed, and least recently used ones go first while
+# output/ exceeds OUTPUT_QUOTA_MB.  Abandoned workspaces and temp files are
+# removed after WORKSPACE_MAX_AGE_HOURS.  PDFs of the newest
+# HISTORY_PROTECT_RUNS history entries are never removed.  One worker sweeps
+# every JANITOR_INTERVAL seconds (0 turns the janitor off).
+RETENTION_DAYS = float(os.environ.get("RETENTION_DAYS", 30))
+OUTPUT_QUOTA_MB = int(os.environ.get("OUTPUT_QUOTA_MB", 2048))
+WORKSPACE_MAX_AGE_HOURS = float(os.environ.get("WORKSPACE_MAX_AGE_HOURS", 6))
+HISTORY_PROTECT_RUNS = int(os.environ.get("HISTORY_PROTECT_RUNS", 20))
+JANITOR_INTERVAL = int(os.environ.get("JANITOR_INTERVAL", 900))
+
+# Downloads carry strong ETags (content hashes) and honour Range requests.
+# With PRECOMPRESS_DOWNLOADS=1 a gzip copy is stored beside a bill or job
+# result the first time it is downloaded and sent to clients that accept
+# gzip; bill PDFs shrink by about a third.
+PRECOMPRESS_DOWNLOADS = os.environ.get("PRECOMPRESS_DOWNLOADS", "0") == "1"
+
+# Uploads are read in chunks of roughly this many rows (never splitting a
+# bill), so rendering starts before a large sheet has been parsed.  Sheets
+# longer than one chunk must be sorted by FreightBillNo; an unsorted one
+# fails once a bill turns up after a later bill was already generated.
+EXCEL_CHUNK_ROWS = int(os.environ.get("EXCEL_CHUNK_ROWS", 2000))
+
+# Structured request logs (one JSON object per line) go to stderr at this level.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+
+# /metrics adds up every worker process: each one stores a snapshot of its
+# metrics in the database every METRICS_PUBLISH_INTERVAL seconds (0 turns
+# that off) and whenever it is scraped.  Snapshots of workers gone for
+# METRICS_WORKER_TTL seconds are dropped, which scrapers see as a reset.
+METRICS_PUBLISH_INTERVAL = int(os.environ.get("METRICS_PUBLISH_INTERVAL", 15))
+METRICS_WORKER_TTL = int(os.environ.get("METRICS_WORKER_TTL", 86400))
+
+# Admin-only features (request profiling) need this token in X-Admin-Token;
+# they are off while it is unset.
+ADMIN_TOKEN = os.environ.get("PORTAL_ADMIN_TOKEN", "")
+
+# Seconds between stack samples taken while a request is being profiled.
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", 0.005))
+
+# Generation output: "zip" (one PDF per bill) or "combined" (every bill in
+# one multi-page PDF with an outline entry per bill).
+OUTPUT_MODES = ("zip", "combined")
+
+# With WARM_START=1, importing the app also loads the heavy modules and
+# renders a sample bill per company (fonts, logos, page layers, templates).
+# The Procfile runs gunicorn with --preload, so this happens once in the
+# master and every forked worker is ready for its first PDF.  Otherwise
+# everything loads on first use.
+WARM_START = os.environ.get("WARM_START", "0") == "1"
+
+DATE_COLUMNS = ['InvoiceDate', 'DueDate', 'ShipmentDate', 'DateArrival', 'DateDelivery']
+AMOUNT_COLUMNS = ['FreightAmt', 'ToPointCharges', 'UnloadingCharge', 'SourceDetention', 'DestinationDetention']
+
 # Company configurations — only STC and Transin
 COMPANIES = {
     "stc": {
@@ -75,25 +240,673 @@ COMPANIES = {
 
 
 # ---------------------------------------------------------------------------
-# Utility helpers
+# Metrics and request logs – stage timings, counters, latency histograms
 # ---------------------------------------------------------------------------
 
-def load_history():
-    if os.path.exists(HISTORY_FILE):
+log = logging.getLogger("portal")
+if not log.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(_log_handler)
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+
+
+def log_event(event, level=logging.INFO, exc_info=False, **fields):
+    """Log one event as a single JSON line."""
+    if log.isEnabledFor(level):
+        log.log(level, json.dumps({"time": _now(), "event": event, **fields}, default=str), exc_info=exc_info)
+
+
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+METRIC_HELP = {
+    "portal_requests_total": ("counter", "Generation, preview and job requests by outcome."),
+    "portal_request_seconds": ("histogram", "Wall time of a whole request or job."),
+    "portal_stage_seconds": ("histogram", "Time per stage; excel_parse includes date_parse, render is per bill."),
+    "portal_bills_total": ("counter", "Bills handled, rendered or reused unchanged."),
+    "portal_startup_seconds": ("gauge", "Start-up time by phase: importing the app, and warm_up() with WARM_START."),
+    "portal_first_request_seconds": ("gauge", "Time until this worker's first response was ready."),
+    "portal_pdf_pool_restarts_total": ("counter", "PDF process pools discarded after a crashed or hung render."),
+}
+
+
+class Metrics:
+    """In-process counters and histograms, rendered in the Prometheus text format.
+
+    Values are per worker process; PDF pool processes report through the
+    worker that submitted the bill.  /metrics merges the snapshots every
+    worker publishes (see collect_metrics).
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}           # key -> [bucket counts..., sum, count]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    def snapshot(self):
+        """Every value as plain lists, ready for json.dumps."""
+        with self._lock:
+            return {
+                "counters": [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                "gauges": [[name, list(labels), value] for (name, labels), value in self._gauges.items()],
+                "histograms": [[name, list(labels), list(hist)] for (name, labels), hist in self._histograms.items()],
+            }
+
+    def merge(self, snapshot, worker=None):
+        """Add a snapshot's counters and histograms to these; its gauges are kept under a worker label.
+
+        Gauges are only taken when worker is given: they describe one
+        process and do not add up.
+        """
+        with self._lock:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                self._counters[key] = self._counters.get(key, 0) + value
+            for name, labels, hist in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                total = self._histograms.get(key)
+                self._histograms[key] = list(hist) if total is None else [a + b for a, b in zip(total, hist)]
+            if worker is not None:
+                for name, labels, value in snapshot["gauges"]:
+                    self._gauges[(name, tuple(sorted(map(tuple, labels + [["worker", worker]]))))] = value
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted((k, list(v)) for k, v in self._histograms.items())
+
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+            return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+        lines = []
+        declared = set()
+
+        def declare(name):
+            if name not in declared:
+                declared.add(name)
+                kind, text = METRIC_HELP.get(name, ("untyped", name))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(name)
+            lines.append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), value in gauges:
+            declare(name)
+            lines.append(f"{name}{fmt(labels)} {value:.6f}")
+        for (name, labels), hist in histograms:
+            declare(name)
+            for bound, count in zip(self.buckets, hist):
+                lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {hist[-1]}")
+            lines.append(f"{name}_sum{fmt(labels)} {hist[-2]:.6f}")
+            lines.append(f"{name}_count{fmt(labels)} {hist[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+_timer_local = threading.local()
+
+
+class RequestTimer:
+    """Stage timings of one request or job, also fed into the metrics.
+
+    Stages timed while the timer is active (see stage()) add up by name;
+    finish() records the request once and logs it with its stage breakdown.
+    """
+
+    def __init__(self, endpoint, company_code=""):
+        self.endpoint = endpoint
+        self.company = company_code
+        self.start = time.perf_counter()
+        self.stages = {}                # name -> [seconds, count]
+        self.finished = False
+
+    def add(self, name, seconds):
+        totals = self.stages.setdefault(name, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += 1
+        metrics.observe("portal_stage_seconds", seconds, stage=name, company=self.company)
+
+    @contextmanager
+    def active(self):
+        previous = getattr(_timer_local, "timer", None)
+        _timer_local.timer = self
+        try:
+            yield self
+        finally:
+            _timer_local.timer = previous
+
+    def finish(self, status="ok", level=logging.INFO, exc_info=False, **fields):
+        if self.finished:
+            return
+        self.finished = True
+        elapsed = time.perf_counter() - self.start
+        metrics.inc("portal_requests_total", endpoint=self.endpoint, company=self.company, status=status)
+        metrics.observe("portal_request_seconds", elapsed, endpoint=self.endpoint, company=self.company)
+        log_event(self.endpoint, level=level, exc_info=exc_info, company=self.company, status=status,
+                  seconds=round(elapsed, 4), **fields,
+                  stages={name: {"seconds": round(sec, 4), "count": n} for name, (sec, n) in self.stages.items()})
+
+
+def record_stage(name, seconds):
+    """Add a measured stage to the active request, or to the metrics alone."""
+    timer = getattr(_timer_local, "timer", None)
+    if timer is not None:
+        timer.add(name, seconds)
+    else:
+        metrics.observe("portal_stage_seconds", seconds, stage=name, company="")
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def timed_iter(iterable, name):
+    """Yield from iterable, recording the time spent producing each item as a stage.
+
+    Only produced items are samples: the call that finds the iterable
+    exhausted is not, so the stage count matches the item count.
+    """
+    items = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        record_stage(name, time.perf_counter() - start)
+        yield item
+
+
+def _metrics_worker():
+    # Read per call: gunicorn --preload imports the app before forking workers.
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def publish_metrics(now=None):
+    """Store this worker's metrics snapshot for collect_metrics; drop those of long-gone workers."""
+    now = time.time() if now is None else now
+    data = json.dumps(metrics.snapshot())
+    with get_db() as conn:
+        conn.execute(
+            "INSERT INTO metrics (worker, updated, data) VALUES (?, ?, ?) "
+            "ON CONFLICT (worker) DO UPDATE SET updated = excluded.updated, data = excluded.data",
+            (_metrics_worker(), now, data)
+        )
+        conn.execute("DELETE FROM metrics WHERE updated < ?", (now - METRICS_WORKER_TTL,))
+
+
+def collect_metrics(now=None):
+    """Metrics of every worker in the Prometheus text format.
+
+    Counters and histograms are summed over the stored snapshots (this
+    worker's is stored first, so it is current; the others are at most
+    METRICS_PUBLISH_INTERVAL old).  Gauges carry a worker label and are
+    only shown for workers that published recently.
+    """
+    now = time.time() if now is None else now
+    publish_metrics(now)
+    live = now - max(3 * METRICS_PUBLISH_INTERVAL, 60)
+    with get_db() as conn:
+        rows = conn.execute("SELECT worker, updated, data FROM metrics ORDER BY worker").fetchall()
+    total = Metrics()
+    for row in rows:
+        total.merge(json.loads(row["data"]), worker=row["worker"] if row["updated"] >= live else None)
+    return total.render()
+
+
+def _metrics_publisher():
+    while True:
+        time.sleep(METRICS_PUBLISH_INTERVAL)
         try:
-            with open(HISTORY_FILE, 'r') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
+            publish_metrics()
+        except sqlite3.Error as e:
+            log_event("metrics", level=logging.WARNING, error=str(e))
+
+
+_metrics_thread = None
+_metrics_lock = threading.Lock()
+
+
+def _ensure_metrics_publisher():
+    """Start the publishing thread lazily so nothing is spawned before a fork."""
+    global _metrics_thread
+    if _metrics_thread is not None or METRICS_PUBLISH_INTERVAL <= 0:
+        return
+    with _metrics_lock:
+        if _metrics_thread is None:
+            _metrics_thread = threading.Thread(target=_metrics_publisher, name="metrics", daemon=True)
+            _metrics_thread.start()
+
+
+# ---------------------------------------------------------------------------
+# Profiling – opt-in, admin-only, for a single generation request
+# ---------------------------------------------------------------------------
+
+_PROFILE_ID = re.compile(r"^[0-9a-f]{32}$")
+PROFILE_ARTIFACTS = ("profile.pstats", "profile.collapsed", "profile.txt")
+
+
+def is_admin():
+    """True if the request carries the configured admin token."""
+    supplied = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode())
+
+
+def profiling_requested():
+    return request.args.get("profile") == "1" or request.headers.get("X-Profile") == "1"
+
+
+class RequestProfiler:
+    """cProfile plus a wall-clock stack sampler on the calling thread.
+
+    cProfile gives exact call counts and times (profile.pstats, and a
+    cumulative-time summary in profile.txt); the sampler records what the
+    thread was doing every PROFILE_SAMPLE_INTERVAL seconds as collapsed
+    stacks (profile.collapsed) for flamegraph tools.  Both stay attached to
+    the thread across the yields of a streamed response.
+    """
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.profile = cProfile.Profile()
+        self.samples = Counter()
+        self._thread_id = None
+        self._stop = threading.Event()
+        self._sampler = None
+        self._running = False
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._sampler = threading.Thread(target=self._sample, name=f"profiler-{self.id[:8]}", daemon=True)
+        self._sampler.start()
+        self.profile.enable()
+        self._running = True
+        return self
+
+    def stop(self):
+        if self._running:
+            self.profile.disable()
+            self._stop.set()
+            self._sampler.join()
+            self._running = False
+
+    def _sample(self):
+        while not self._stop.wait(PROFILE_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def finish(self):
+        """Stop, store the artifacts under PROFILES_FOLDER/<id>/ and return them as (name, bytes)."""
+        self.stop()
+        folder = os.path.join(PROFILES_FOLDER, self.id)
+        os.makedirs(folder, exist_ok=True)
+
+        stats_path = os.path.join(folder, "profile.pstats")
+        pstats.Stats(self.profile).dump_stats(stats_path)
+        with open(stats_path, 'rb') as f:
+            stats_data = f.read()
+
+        collapsed = "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common()).encode()
+
+        summary = io.StringIO()
+        pstats.Stats(self.profile, stream=summary).sort_stats("cumulative").print_stats(60)
+
+        artifacts = [("profile.pstats", stats_data), ("profile.collapsed", collapsed),
+                     ("profile.txt", summary.getvalue().encode())]
+        for name, data in artifacts[1:]:
+            with open(os.path.join(folder, name), 'wb') as f:
+                f.write(data)
+        return artifacts
+
+
+# ---------------------------------------------------------------------------
+# Utility helpers
+# ---------------------------------------------------------------------------
+
+@contextmanager
+def get_db():
+    """SQLite connection that commits on success and is always closed."""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def init_db():
+    with get_db() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id           TEXT PRIMARY KEY,
+                status       TEXT NOT NULL,
+                file         TEXT NOT NULL,
+                company_code TEXT NOT NULL,
+                created      TEXT NOT NULL,
+                started      TEXT,
+                finished     TEXT,
+                rows         INTEGER,
+                total_bills  INTEGER NOT NULL DEFAULT 0,
+                done_bills   INTEGER NOT NULL DEFAULT 0,
+                error        TEXT,
+                result_path  TEXT,
+                reused_bills INTEGER NOT NULL DEFAULT 0,
+                output       TEXT NOT NULL DEFAULT 'zip',
+                upload_path  TEXT,
+                token        TEXT,
+                persist      INTEGER NOT NULL DEFAULT 1,
+                owner        TEXT,
+                heartbeat    REAL,
+                attempts     INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS job_bills (
+                job_id  TEXT NOT NULL,
+                seq     INTEGER NOT NULL,
+                bill_no TEXT NOT NULL,
+                status  TEXT NOT NULL,
+                PRIMARY KEY (job_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS history (
+                id           INTEGER PRIMARY KEY AUTOINCREMENT,
+                time         TEXT NOT NULL,
+                file         TEXT NOT NULL,
+                company      TEXT NOT NULL,
+                company_code TEXT NOT NULL,
+                rows         INTEGER NOT NULL,
+                bill_count   INTEGER NOT NULL,
+                reused       INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS history_time ON history (time);
+            CREATE INDEX IF NOT EXISTS history_company_time ON history (company_code, time);
+            CREATE TABLE IF NOT EXISTS history_bills (
+                history_id INTEGER NOT NULL REFERENCES history (id),
+                seq        INTEGER NOT NULL,
+                bill_no    TEXT NOT NULL,
+                pdf_file   TEXT,
+                PRIMARY KEY (history_id, seq)
+            );
+            CREATE INDEX IF NOT EXISTS history_bills_bill_no ON history_bills (bill_no);
+            CREATE INDEX IF NOT EXISTS history_bills_pdf_file ON history_bills (pdf_file);
+            CREATE TABLE IF NOT EXISTS bills (
+                pdf_file       TEXT PRIMARY KEY,
+                company_code   TEXT NOT NULL,
+                bill_no        TEXT NOT NULL,
+                invoice_date   TEXT,
+                due_date       TEXT,
+                first_shipment TEXT,
+                last_shipment  TEXT,
+                total          REAL NOT NULL,
+                rows           INTEGER NOT NULL,
+                updated        TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS bills_bill_no ON bills (bill_no);
+            CREATE INDEX IF NOT EXISTS bills_company_bill_no ON bills (company_code, bill_no);
+            CREATE INDEX IF NOT EXISTS bills_invoice_date ON bills (invoice_date);
+            CREATE INDEX IF NOT EXISTS bills_total ON bills (total);
+            CREATE TABLE IF NOT EXISTS bill_refs (
+                pdf_file TEXT NOT NULL REFERENCES bills (pdf_file),
+                kind     TEXT NOT NULL,
+                value    TEXT NOT NULL,
+                PRIMARY KEY (kind, value, pdf_file)
+            );
+            CREATE INDEX IF NOT EXISTS bill_refs_value ON bill_refs (value);
+            CREATE TABLE IF NOT EXISTS file_access (
+                path        TEXT PRIMARY KEY,
+                last_access REAL NOT NULL,
+                downloads   INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS janitor (
+                id       INTEGER PRIMARY KEY CHECK (id = 1),
+                last_run REAL NOT NULL
+            );
+            INSERT OR IGNORE INTO janitor (id, last_run) VALUES (1, 0);
+            CREATE TABLE IF NOT EXISTS metrics (
+                worker  TEXT PRIMARY KEY,
+                updated REAL NOT NULL,
+                data    TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS bill_refs_pdf_file ON bill_refs (pdf_file);
+        """)
+        # Columns added after the first release
+        _add_column(conn, "jobs", "reused_bills", "INTEGER NOT NULL DEFAULT 0")
+        _add_column(conn, "jobs", "output", "TEXT NOT NULL DEFAULT 'zip'")
+        _add_column(conn, "jobs", "upload_path", "TEXT")
+        _add_column(conn, "jobs", "token", "TEXT")
+        _add_column(conn, "jobs", "persist", "INTEGER NOT NULL DEFAULT 1")
+        _add_column(conn, "jobs", "owner", "TEXT")
+        _add_column(conn, "jobs", "heartbeat", "REAL")
+        _add_column(conn, "jobs", "attempts", "INTEGER NOT NULL DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+
+def _add_column(conn, table, column, ddl):
+    """Add a column if missing; several workers may start and try at once."""
+    if column in {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}:
+        return
+    try:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    except sqlite3.OperationalError as e:
+        if "duplicate column" not in str(e):
+            raise
+
+
+# Bills listed per entry by /api/history; /api/history/<id> has them all.
+HISTORY_PREVIEW_BILLS = 5
+
+
+def _insert_history(conn, entry):
+    # Entries written by older versions may lack company and bill fields.
+    company_code = entry.get("company_code", "stc")
+    company = entry.get("company") or COMPANIES.get(company_code, {}).get("name", company_code.upper())
+    bills = [str(b) for b in entry.get("bills") or []]
+    pdf_files = set(entry.get("pdf_files") or [])
+
+    cur = conn.execute(
+        "INSERT INTO history (time, file, company, company_code, rows, bill_count, reused) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (entry["time"], entry.get("file", ""), company, company_code,
+         entry.get("rows", 0), len(bills), entry.get("reused", 0))
+    )
+    conn.executemany(
+        "INSERT INTO history_bills (history_id, seq, bill_no, pdf_file) VALUES (?, ?, ?, ?)",
+        [
+            (cur.lastrowid, seq, bill_no, pdf if pdf in pdf_files else None)
+            for seq, bill_no in enumerate(bills)
+            for pdf in [bill_pdf_name(bill_no, company_code)]
+        ]
+    )
+    return cur.lastrowid
+
+
+def migrate_history_file():
+    """Import history.json into the history table if the table is still empty."""
+    if not os.path.exists(HISTORY_FILE):
+        return
+    try:
+        with open(HISTORY_FILE, 'r') as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        log_event("history_import", level=logging.WARNING, status="skipped", error=str(e))
+        return
+    with get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")          # one worker imports, the rest see rows
+        if conn.execute("SELECT 1 FROM history LIMIT 1").fetchone():
+            return
+        for entry in reversed(entries):          # file is newest first
+            _insert_history(conn, entry)
+    log_event("history_import", status="ok", entries=len(entries), file=HISTORY_FILE)
 
 
 def save_history(entry):
-    history = load_history()
-    history.insert(0, entry)
-    history = history[:20]
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(history, f, indent=2)
+    """Append one generation run (bills and PDFs included) in a single transaction."""
+    with stage("history_write"), get_db() as conn:
+        return _insert_history(conn, entry)
+
+
+def _history_dict(conn, row, bill_limit=HISTORY_PREVIEW_BILLS):
+    bills = conn.execute(
+        "SELECT bill_no, pdf_file FROM history_bills WHERE history_id = ? ORDER BY seq LIMIT ?",
+        (row["id"], -1 if bill_limit is None else bill_limit)
+    ).fetchall()
+    entry = dict(row)
+    entry["bills"] = [b["bill_no"] for b in bills]
+    entry["pdf_files"] = [b["pdf_file"] for b in bills if b["pdf_file"]]
+    return entry
+
+
+def load_history(limit=20, offset=0, company_code=None, bill=None, file=None, since=None, until=None):
+    """Newest-first history entries matching the filters, and the total number that match.
+
+    bill matches bill numbers by prefix, file is a substring of the upload
+    name, and since/until bound the run time ('YYYY-MM-DD[ HH:MM:SS]').
+    """
+    where, params = [], []
+    if company_code:
+        where.append("company_code = ?")
+        params.append(company_code)
+    if bill:
+        where.append("id IN (SELECT history_id FROM history_bills WHERE bill_no >= ? AND bill_no < ?)")
+        params += [bill, bill + "\uffff"]
+    if file:
+        where.append("file LIKE ? ESCAPE '\\'")
+        params.append("%" + re.sub(r"([%_\\])", r"\\\1", file) + "%")
+    if since:
+        where.append("time >= ?")
+        params.append(since)
+    if until:
+        where.append("time <= ?")
+        params.append(until + " 23:59:59" if len(until) == 10 else until)
+    clause = f"WHERE {' AND '.join(where)}" if where else ""
+
+    with get_db() as conn:
+        total = conn.execute(f"SELECT COUNT(*) FROM history {clause}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT * FROM history {clause} ORDER BY time DESC, id DESC LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        ).fetchall()
+        return [_history_dict(conn, row) for row in rows], total
+
+
+def get_history_entry(entry_id):
+    """One history entry with every bill it produced, or None."""
+    with get_db() as conn:
+        row = conn.execute("SELECT * FROM history WHERE id = ?", (entry_id,)).fetchone()
+        return _history_dict(conn, row, bill_limit=None) if row else None
+
+
+def new_workspace(kind="req"):
+    """A private directory under UPLOAD_FOLDER for one request's or job's files."""
+    return tempfile.mkdtemp(prefix=f"{kind}-", dir=UPLOAD_FOLDER)
+
+
+def remove_workspace(path):
+    if path is not None:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def workspace_path(workspace, filename):
+    """Where an upload called filename is saved inside a workspace."""
+    return os.path.join(workspace, secure_filename(filename) or "upload.xlsx")
+
+
+def atomic_write(path, data):
+    """Publish bytes at path all at once: readers see the old file or the new one, never half."""
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class ZipStreamBuffer:
+    """Write-only file object for zipfile; collects output until drained."""
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries):
+    """Yield a ZIP archive chunk by chunk from (name, bytes) entries as they arrive."""
+    buf = ZipStreamBuffer()
+    with zipfile.ZipFile(buf, 'w') as zipf:
+        for name, data in entries:
+            with stage("zip"):
+                zipf.writestr(name, data)
+            yield buf.drain()
+    yield buf.drain()
 
 
 def safe_parse_date(val):
@@ -115,14 +928,296 @@ def safe_parse_date(val):
 
 
 def parse_date_column(series):
-    """Apply safe_parse_date to an entire pandas Series."""
-    return series.apply(safe_parse_date)
+    """Vectorised safe_parse_date – same result as series.apply(safe_parse_date).
+
+    Real date cells pass straight through, 8-digit ddmmyyyy / yyyymmdd and
+    dd-mm-yyyy style strings are parsed in bulk to_datetime calls, and whatever
+    is left (other formats, numbers) goes through safe_parse_date once per
+    distinct value.
+    """
+    if series.empty:
+        return series.apply(safe_parse_date)
+    if pd.api.types.is_datetime64_dtype(series) and series.notna().any():
+        return series.copy()
+
+    values = series.to_numpy(dtype=object)
+    result = np.full(len(values), pd.NaT, dtype=object)
+
+    missing = pd.isna(values)
+    is_datetime = np.fromiter((isinstance(v, datetime) for v in values), dtype=bool, count=len(values))
+    is_datetime &= ~missing
+    result[is_datetime] = values[is_datetime]
+
+    rest = np.flatnonzero(~(missing | is_datetime))
+    if len(rest):
+        raw = pd.Series(values[rest], dtype=object).astype(str)
+        text = raw.str.strip()
+        todo = np.ones(len(rest), dtype=bool)
+
+        eight = text.str.fullmatch(r"[0-9]{8}").to_numpy(dtype=bool)
+        if eight.any():
+            digits = text[eight]
+            parsed = pd.to_datetime(digits, format='%d%m%Y', errors='coerce').to_numpy(dtype=object)
+            retry = pd.isna(parsed)
+            if retry.any():
+                parsed[retry] = pd.to_datetime(digits[retry], format='%Y%m%d', errors='coerce').to_numpy(dtype=object)
+            result[rest[eight]] = parsed
+            todo &= ~eight
+
+        # dd-mm-yyyy style strings: a strict dayfirst format gives the same
+        # answer as dayfirst parsing whenever it matches; the rest falls through.
+        for sep in "-/.":
+            dayfirst = todo & raw.str.fullmatch(rf"[0-9]{{1,2}}\{sep}[0-9]{{1,2}}\{sep}[0-9]{{4}}").to_numpy(dtype=bool)
+            if dayfirst.any():
+                parsed = pd.to_datetime(raw[dayfirst], format=f"%d{sep}%m{sep}%Y", errors='coerce').to_numpy(dtype=object)
+                ok = ~pd.isna(parsed)
+                result[rest[dayfirst][ok]] = parsed[ok]
+                todo[np.flatnonzero(dayfirst)[ok]] = False
+
+        cache = {}
+        for pos in rest[todo]:
+            val = values[pos]
+            key = (type(val), val)
+            if key not in cache:
+                cache[key] = safe_parse_date(val)
+            result[pos] = cache[key]
+
+    return pd.Series(result, index=series.index, name=series.name)
+
+
+def normalise_dates(df):
+    with stage("date_parse"):
+        for col in DATE_COLUMNS:
+            if col in df.columns:
+                df[col] = parse_date_column(df[col])
+    return df
 
 
-def create_excel_template(company_code="stc"):
-    """Create Excel template file based on company type"""
-    template_file = f"excel_template_{company_code}.xlsx"
+def load_bill_sheet(path):
+    """Read an uploaded workbook and normalise every date column it has."""
+    with stage("excel_parse"):
+        return normalise_dates(pd.read_excel(path))
+
+
+_UPLOAD_TOKEN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def upload_digest(file):
+    """sha256 of an uploaded file – its upload token – leaving the stream rewound."""
+    digest = hashlib.sha256()
+    for block in iter(lambda: file.stream.read(1 << 20), b""):
+        digest.update(block)
+    file.stream.seek(0)
+    return digest.hexdigest()
+
+
+def _parse_cache_path(token):
+    return os.path.join(PARSE_CACHE_FOLDER, f"{token}.pkl")
+
+
+def cached_bill_sheet(token):
+    """The parsed sheet stored under an upload token, or None if unknown or evicted."""
+    if not token or not _UPLOAD_TOKEN.match(token):
+        return None
+    path = _parse_cache_path(token)
+    try:
+        df = pd.read_pickle(path)
+        os.utime(path)                    # mark as recently used
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log_event("parse_cache", level=logging.WARNING, token=token, error=str(e))
+        return None
+    return df
+
+
+def cache_bill_sheet(token, df, filename):
+    """Store a parsed sheet (output of load_bill_sheet) under its upload token."""
+    df.attrs["filename"] = filename
+    path = _parse_cache_path(token)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    df.to_pickle(tmp)
+    os.replace(tmp, path)
+    _trim_parse_cache()
+
+
+def _trim_parse_cache():
+    entries = []
+    for name in os.listdir(PARSE_CACHE_FOLDER):
+        if name.endswith(".pkl"):
+            try:
+                st = os.stat(os.path.join(PARSE_CACHE_FOLDER, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    limit = PARSE_CACHE_MAX_MB * 1024 * 1024
+    for _, size, name in sorted(entries)[:-1]:     # never evict the newest entry
+        if total <= limit:
+            break
+        try:
+            os.remove(os.path.join(PARSE_CACHE_FOLDER, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def resolve_upload():
+    """Find the sheet a generation request refers to.
+
+    Requests may send the upload_token returned by /preview instead of, or
+    as well as, the file.  Returns (file, token, df, error): df is the cached
+    parsed sheet or None, file is None when only a token was sent, and error
+    is a (response, status) pair to return as-is.
+    """
+    token = request.form.get("upload_token", "")
+    df = cached_bill_sheet(token)
+    file = request.files.get("file")
+
+    if df is None:
+        if file is None:
+            if token:
+                return None, None, None, (jsonify({"error": "Upload expired, please choose the file again"}), 410)
+            return None, None, None, (jsonify({"error": "No file uploaded"}), 400)
+        if file.filename == "":
+            return None, None, None, (jsonify({"error": "No file selected"}), 400)
+        token = upload_digest(file)
+        df = cached_bill_sheet(token)
+
+    return file, token, df, None
+
+
+def _excel_value(value):
+    """A read-only openpyxl value converted the way pd.read_excel converts cells."""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value in xl_cell.ERROR_CODES:
+        return np.nan
+    return value
+
+
+def _sheet_header(rows):
+    """Header of a sheet from its row iterator, without trailing blank cells."""
+    header = [_excel_value(v) for v in next(rows, ())]
+    while header and header[-1] == "":
+        header.pop()
+    if "FreightBillNo" not in header:
+        raise KeyError("FreightBillNo")
+    return header
+
+
+def _is_blank_bill(bill_no):
+    return bill_no == "" or bill_no is None or (isinstance(bill_no, float) and bill_no != bill_no)
+
+
+def iter_sheet_chunks(path, chunk_rows=None):
+    """Stream the first sheet of a workbook as DataFrames of whole bills.
+
+    Rows are read with openpyxl in read-only mode and handed to the same
+    TextParser pd.read_excel uses, about chunk_rows at a time, so memory
+    stays flat however long the sheet is.  A chunk only ends before a new
+    FreightBillNo, so the bill being read when a chunk fills is carried on
+    until its rows end and every bill lies in a single chunk.  Column dtypes
+    are inferred per chunk, so a sheet that fits in one chunk reads exactly
+    like pd.read_excel.
+
+    Order is checked as the sheet is read: every bill must sort after all
+    bills of earlier chunks, so that chunk by chunk the bills come out in
+    the order of iter_bill_groups.  A bill that turns up again after its
+    chunk was handed out, or sorts before one already handed out, raises
+    ValueError – the sheet has to be sorted by FreightBillNo to stream.
+    """
+    chunk_rows = EXCEL_CHUNK_ROWS if chunk_rows is None else chunk_rows
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()
+        rows = ws.iter_rows(values_only=True)
+
+        header = _sheet_header(rows)
+        width = len(header)
+        key = header.index("FreightBillNo")
+
+        def frame(chunk):
+            return normalise_dates(pd.io.parsers.TextParser([header] + chunk, header=0).read())
+
+        chunk = []
+        chunk_bills = set()
+        done_bills = set()
+        done_max = None                   # highest bill number handed out so far
+        for row in rows:
+            row = [_excel_value(v) for v in row[:width]]
+            row.extend([""] * (width - len(row)))
+            bill_no = row[key]
+            if _is_blank_bill(bill_no):
+                continue
+            if bill_no not in chunk_bills:
+                if bill_no in done_bills:
+                    raise ValueError(f"Rows of freight bill {bill_no} are more than {chunk_rows} rows "
+                                     f"apart – sort the sheet by FreightBillNo")
+                try:
+                    out_of_order = done_max is not None and bill_no < done_max
+                except TypeError:         # bill numbers of mixed types do not sort
+                    out_of_order = True
+                if out_of_order:
+                    raise ValueError(f"Freight bill {bill_no} comes after bill {done_max} was generated "
+                                     f"– sort the sheet by FreightBillNo")
+                if len(chunk) >= chunk_rows:
+                    try:
+                        chunk_max = max(chunk_bills)
+                    except TypeError:
+                        raise ValueError("FreightBillNo mixes numbers and text – make every bill "
+                                         "number text to generate a sheet this long") from None
+                    yield frame(chunk)
+                    done_bills |= chunk_bills
+                    done_max = chunk_max
+                    chunk, chunk_bills = [], set()
+                chunk_bills.add(bill_no)
+            chunk.append(row)
+        if chunk:
+            yield frame(chunk)
+    finally:
+        wb.close()
+
+
+def iter_sheet_bills(path, company_code, stats=None):
+    """Yield prepared (bill_no, rows) groups straight from the workbook.
+
+    Bills come out chunk by chunk, sorted within each chunk, which is the
+    order of iter_bill_groups; unsorted sheets raise ValueError part way
+    (see iter_sheet_chunks).
+
+    stats, if given, is filled in as the sheet is read: "rows" counts data
+    rows and "bills" lists bill numbers.
+    """
+    for chunk in timed_iter(iter_sheet_chunks(path), "excel_parse"):
+        df = prepare_bills(chunk, company_code)
+        if stats is not None:
+            stats["rows"] = stats.get("rows", 0) + len(df)
+        for bill_no, group_df in df.groupby('FreightBillNo'):
+            if stats is not None:
+                stats.setdefault("bills", []).append(bill_no)
+            yield bill_no, group_df.reset_index(drop=True)
+
+
+def make_history_entry(filename, company_code, rows, bill_numbers, pdf_files, reused=0):
+    return {
+        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "file": filename,
+        "company": COMPANIES[company_code]["name"],
+        "company_code": company_code,
+        "rows": rows,
+        "bills": [str(b) for b in bill_numbers],
+        "pdf_files": [os.path.basename(f) for f in pdf_files],
+        "reused": reused
+    }
+
 
+def template_sample(company_code="stc"):
+    """Sample row of the upload template, column by column, for a company type"""
     if company_code == "transin":
         columns = [
             'FreightBillNo', 'InvoiceDate', 'DueDate', 'FromLocation',
@@ -180,10 +1275,51 @@ def create_excel_template(company_code="stc"):
             'DestinationDetention': [0]
         }
 
-    df = pd.DataFrame(sample_data)
-    df.to_excel(template_file, index=False)
-    print(f"✓ Template created: {template_file}")
-    return template_file
+    return sample_data
+
+
+def create_excel_template(company_code="stc"):
+    """Build the Excel template for a company and return the .xlsx bytes"""
+    buf = io.BytesIO()
+    pd.DataFrame(template_sample(company_code)).to_excel(buf, index=False)
+    return buf.getvalue()
+
+
+# Built templates by company: (fingerprint, etag, xlsx bytes, last modified epoch seconds)
+_templates = {}
+_templates_lock = threading.Lock()
+# Templates are defined in this file, so they change when it does. Epoch
+# seconds, not naive datetimes: Werkzeug reads those as UTC.
+_TEMPLATE_MTIME = int(os.path.getmtime(__file__))
+
+
+def _template_fingerprint(company_code):
+    """Hash of everything a template is built from; a new one means a rebuild."""
+    source = {"sample": template_sample(company_code), "company": COMPANIES[company_code]}
+    return hashlib.sha256(json.dumps(source, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+def excel_template(company_code):
+    """(etag, xlsx bytes, last modified) for a company, built on first use or config change.
+
+    The ETag hashes the bytes served, not the fingerprint: openpyxl stamps
+    the build time into every workbook, so two builds of one fingerprint
+    (another worker, a restart) differ, and a Range request resumed
+    against the other build must not be stitched onto this one.
+    """
+    fingerprint = _template_fingerprint(company_code)
+    cached = _templates.get(company_code)
+    if cached is None or cached[0] != fingerprint:
+        with _templates_lock:
+            cached = _templates.get(company_code)
+            if cached is None or cached[0] != fingerprint:
+                with stage("template_build"):
+                    data = create_excel_template(company_code)
+                etag = hashlib.sha256(data).hexdigest()[:32]
+                modified = _TEMPLATE_MTIME if cached is None else int(time.time())
+                cached = _templates[company_code] = (fingerprint, etag, data, modified)
+                log_event("template", company=company_code, etag=etag, bytes=len(data))
+    return cached[1:]
 
 
 # ---------------------------------------------------------------------------
@@ -191,11 +1327,18 @@ def create_excel_template(company_code="stc"):
 # ---------------------------------------------------------------------------
 
 def wrap_text_lines(c, text, max_width, font_name="Helvetica", font_size=7):
-    """Wrap text to fit within max_width. Newlines are normalised to '/' first."""
-    text = str(text).replace('\n', '/')
+    """Wrap text to fit within max_width. Newlines are normalised to '/' first.
+
+    Results are cached on (text, max_width, font_name, font_size); the canvas
+    is not needed for measuring and is only kept for the call signature.
+    """
+    return list(_wrap_text_cached(str(text).replace('\n', '/'), max_width, font_name, font_size))
+
+
+@lru_cache(maxsize=WRAP_CACHE_SIZE)
+def _wrap_text_cached(text, max_width, font_name, font_size):
     lines = []
     current_line = ""
-    c.setFont(font_name, font_size)
 
     if '/' in text:
         parts = text.split('/')
@@ -203,7 +1346,7 @@ def wrap_text_lines(c, text, max_width, font_name="Helvetica", font_size=7):
             test_line = current_line + part
             if i < len(parts) - 1:
                 test_line += "/"
-            if c.stringWidth(test_line, font_name, font_size) <= max_width:
+            if pdfmetrics.stringWidth(test_line, font_name, font_size) <= max_width:
                 current_line = test_line
             else:
                 if current_line:
@@ -217,7 +1360,7 @@ def wrap_text_lines(c, text, max_width, font_name="Helvetica", font_size=7):
         words = text.split()
         for word in words:
             test_line = current_line + (" " if current_line else "") + word
-            if c.stringWidth(test_line, font_name, font_size) <= max_width:
+            if pdfmetrics.stringWidth(test_line, font_name, font_size) <= max_width:
                 current_line = test_line
             else:
                 if current_line:
@@ -226,7 +1369,13 @@ def wrap_text_lines(c, text, max_width, font_name="Helvetica", font_size=7):
         if current_line:
             lines.append(current_line)
 
-    return lines if lines else [text]
+    return tuple(lines) if lines else (text,)
+
+
+def wrap_cache_stats():
+    """Hit/miss counters of the wrapped-line cache (per process)."""
+    info = _wrap_text_cached.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
 
 
 def draw_wrapped_text(c, text, x, y, max_width, font_name="Helvetica", font_size=7, line_height=7):
@@ -253,8 +1402,14 @@ def download_template():
     company_code = request.args.get("company", "stc")
     if company_code not in COMPANIES:
         company_code = "stc"
-    template_file = create_excel_template(company_code)
-    return send_file(template_file, as_attachment=True, download_name=f"{company_code.upper()}_Template.xlsx")
+    etag, data, modified = excel_template(company_code)
+    # conditional=True answers If-None-Match / If-Modified-Since with 304
+    response = send_file(io.BytesIO(data), as_attachment=True,
+                         download_name=f"{company_code.upper()}_Template.xlsx",
+                         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                         etag=etag, last_modified=modified, conditional=True)
+    response.cache_control.no_cache = True
+    return response
 
 
 @app.route("/api/companies")
@@ -278,67 +1433,124 @@ def get_company(company_code):
 
 @app.route("/", methods=["POST"])
 def generate_bills():
-    try:
-        if "file" not in request.files:
-            return jsonify({"error": "No file uploaded"}), 400
-
-        file = request.files["file"]
-        company_code = request.form.get("company", "stc")
+    if profiling_requested() and not is_admin():
+        return jsonify({"error": "Profiling is restricted to admins"}), 403
 
-        if file.filename == "":
-            return jsonify({"error": "No file selected"}), 400
+    timer = RequestTimer("generate")
+    profiler = None
+    workspace = None                      # holds the saved upload until the response is done
+    try:
+        with timer.active():
+            file, token, cached, error = resolve_upload()
+            if error:
+                return error
 
-        if company_code not in COMPANIES:
-            return jsonify({"error": "Invalid company selected"}), 400
+            company_code = request.form.get("company", "stc")
 
-        print(f"📄 File received: {file.filename}")
-        print(f"🏢 Company: {COMPANIES[company_code]['name']}")
+            if company_code not in COMPANIES:
+                return jsonify({"error": "Invalid company selected"}), 400
+            timer.company = company_code
 
-        path = os.path.join(UPLOAD_FOLDER, file.filename)
-        file.save(path)
+            output = request.form.get("output", "zip")
+            if output not in OUTPUT_MODES:
+                return jsonify({"error": f"Unknown output mode: {output}"}), 400
 
-        df = pd.read_excel(path)
-        print(f"✓ Excel loaded: {len(df)} rows")
+            if profiling_requested():
+                # Everything runs on this thread so the profile sees the renders too.
+                profiler = RequestProfiler().start()
 
-        # Robust date parsing for ALL date columns that exist
-        date_columns = ['InvoiceDate', 'DueDate', 'ShipmentDate', 'DateArrival', 'DateDelivery']
-        for col in date_columns:
-            if col in df.columns:
-                df[col] = parse_date_column(df[col])
+            filename = file.filename if file is not None else cached.attrs.get("filename", f"{token[:12]}.xlsx")
 
-        pdf_files = generate_multiple_pdfs(df, company_code)
-        print(f"✓ Generated {len(pdf_files)} PDF(s)")
-
-        bill_numbers = df['FreightBillNo'].unique().tolist()
-        history_entry = {
-            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "file": file.filename,
-            "company": COMPANIES[company_code]["name"],
-            "company_code": company_code,
-            "rows": len(df),
-            "bills": [str(b) for b in bill_numbers[:5]],
-            "pdf_files": [os.path.basename(f) for f in pdf_files]
-        }
-        save_history(history_entry)
+            if cached is not None:
+                # Parsed already (by /preview or an earlier run of the same file)
+                df = prepare_bills(cached, company_code)
+                sheet = {"rows": len(df), "bills": df['FreightBillNo'].unique().tolist()}
+                groups = iter_bill_groups(df)
+            else:
+                workspace = new_workspace()
+                path = workspace_path(workspace, file.filename)
+                with stage("upload_save"):
+                    file.save(path)
+                # Bills are rendered as the sheet is read; an unsorted sheet
+                # fails once its order is found out.
+                sheet = {"rows": 0, "bills": []}
+                groups = iter_sheet_bills(path, company_code, sheet)
+
+        if output == "combined":
+            # One PDF for the whole upload; it is complete before anything is sent.
+            buf = io.BytesIO()
+            with timer.active():
+                write_combined_pdf(groups, company_code, buf)
+                save_history(make_history_entry(filename, company_code, sheet["rows"], sheet["bills"], []))
+            remove_workspace(workspace)
+            if profiler is not None:
+                profiler.finish()
+            timer.finish("ok", output=output, file=filename, cached=cached is not None, rows=sheet["rows"],
+                         bills=len(sheet["bills"]), profile=profiler.id if profiler is not None else None)
+            buf.seek(0)
+            response = send_file(buf, mimetype="application/pdf", as_attachment=True,
+                                 download_name=combined_pdf_name(company_code))
+            if profiler is not None:
+                response.headers["X-Profile-Id"] = profiler.id
+            return response
 
         zip_filename = f"{company_code.upper()}_Bills.zip"
-        zip_path = os.path.join(OUTPUT_FOLDER, zip_filename)
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for pdf_file in pdf_files:
-                zipf.write(pdf_file, os.path.basename(pdf_file))
 
-        print(f"✓ ZIP created: {zip_path}")
-        return send_file(zip_path, as_attachment=True, download_name=zip_filename)
+        persist = request.form.get("persist", "1" if PERSIST_PDFS else "0") == "1"
+
+        def stream():
+            pdf_files = []
+            render_stats = {}
+
+            def rendered():
+                workers = 1 if profiler is not None else None
+                for name, data in iter_bill_pdfs(groups, company_code, workers, stats=render_stats):
+                    if persist:
+                        pdf_files.append(keep_pdf(name, data, render_stats))
+                    yield name, data
+                save_history(make_history_entry(filename, company_code, sheet["rows"], sheet["bills"],
+                                                pdf_files, reused=render_stats["reused"]))
+                if profiler is not None:
+                    for name, data in profiler.finish():
+                        yield f"_profile/{name}", data
+
+            with timer.active():
+                try:
+                    yield from stream_zip(rendered())
+                except GeneratorExit:
+                    timer.finish("aborted", file=filename, rows=sheet["rows"], bills=len(sheet["bills"]))
+                    raise
+                except Exception as e:
+                    timer.finish("error", level=logging.ERROR, exc_info=True, file=filename, error=str(e))
+                    raise
+                finally:
+                    if profiler is not None:
+                        profiler.stop()
+                    remove_workspace(workspace)
+                timer.finish("ok", file=filename, cached=cached is not None, rows=sheet["rows"],
+                             bills=len(sheet["bills"]), reused=render_stats["reused"],
+                             profile=profiler.id if profiler is not None else None)
+
+        # Render the first bill before committing to a 200 so that bad sheets
+        # still get a JSON error instead of a truncated download.
+        body = stream()
+        first_chunk = next(body)
+        headers = {"Content-Disposition": f"attachment; filename={zip_filename}"}
+        if profiler is not None:
+            headers["X-Profile-Id"] = profiler.id
+        return Response(chain([first_chunk], body), mimetype="application/zip", headers=headers)
 
     except Exception as e:
-        print(f"❌ ERROR: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        if profiler is not None:
+            profiler.stop()
+        remove_workspace(workspace)
+        timer.finish("error", level=logging.ERROR, exc_info=True, error=str(e))
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/preview", methods=["POST"])
 def preview():
+    timer = RequestTimer("preview")
     try:
         if "file" not in request.files:
             return jsonify({"ok": False, "error": "No file uploaded"}), 400
@@ -347,309 +1559,1821 @@ def preview():
         if file.filename == "":
             return jsonify({"ok": False, "error": "No file selected"}), 400
 
-        path = os.path.join(UPLOAD_FOLDER, f"preview_{file.filename}")
-        file.save(path)
-
-        df = pd.read_excel(path)
-
-        date_columns = ['InvoiceDate', 'DueDate', 'ShipmentDate', 'DateArrival', 'DateDelivery']
-        for col in date_columns:
-            if col in df.columns:
-                df[col] = parse_date_column(df[col])
-
-        rows = []
-        for idx, row in df.iterrows():
-            total = (
-                float(row.get("FreightAmt", 0)) +
-                float(row.get("ToPointCharges", 0)) +
-                float(row.get("UnloadingCharge", 0)) +
-                float(row.get("SourceDetention", 0)) +
-                float(row.get("DestinationDetention", 0))
-            )
-            rows.append({
-                "FreightBillNo": str(row.get("FreightBillNo", "")),
-                "LRNo": str(row.get("LRNo", "")),
-                "TruckNo": str(row.get("TruckNo", "")),
-                "InvoiceNo": str(row.get("InvoiceNo", "")),
-                "Destination": str(row.get("Destination", "")),
-                "TotalAmount": f"₹{total:.2f}"
-            })
-
-        os.remove(path)
-        return jsonify({"ok": True, "count": len(df), "rows": rows})
+        with timer.active():
+            token = upload_digest(file)
+            df = cached_bill_sheet(token)
+            cached = df is not None
+            if df is None:
+                workspace = new_workspace("preview")
+                try:
+                    path = workspace_path(workspace, file.filename)
+                    with stage("upload_save"):
+                        file.save(path)
+                    df = load_bill_sheet(path)
+                finally:
+                    remove_workspace(workspace)
+                cache_bill_sheet(token, df, file.filename)
+
+            preview_df = pd.DataFrame({
+                col: _text(df[col]) if col in df.columns else ""
+                for col in ["FreightBillNo", "LRNo", "TruckNo", "InvoiceNo", "Destination"]
+            }, index=df.index)
+            preview_df["TotalAmount"] = row_totals(df).map("₹{:.2f}".format)
+            rows = preview_df.to_dict("records")
+
+        timer.finish("ok", file=file.filename, cached=cached, rows=len(df))
+        return jsonify({"ok": True, "count": len(df), "rows": rows, "upload_token": token})
 
     except Exception as e:
-        print(f"Preview ERROR: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        timer.finish("error", level=logging.ERROR, exc_info=True, error=str(e))
         return jsonify({"ok": False, "error": str(e)}), 500
 
 
 @app.route("/api/history")
 def get_history():
+    """Paginated history: ?limit=&offset= plus optional company, bill (prefix), file, from, to."""
+    try:
+        limit = min(max(int(request.args.get("limit", 20)), 1), 100)
+        offset = max(int(request.args.get("offset", 0)), 0)
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+
     try:
-        history = load_history()
-        return jsonify(history if history else [])
+        items, total = load_history(
+            limit, offset,
+            company_code=request.args.get("company"),
+            bill=request.args.get("bill"),
+            file=request.args.get("file"),
+            since=request.args.get("from"),
+            until=request.args.get("to"),
+        )
     except Exception as e:
-        print(f"History error: {e}")
-        return jsonify([])
+        log_event("history", level=logging.ERROR, error=str(e))
+        items, total = [], 0
+    return jsonify({"items": items, "total": total, "limit": limit, "offset": offset})
+
+
+@app.route("/api/history/<int:entry_id>")
+def get_history_detail(entry_id):
+    entry = get_history_entry(entry_id)
+    if entry is None:
+        return jsonify({"error": "History entry not found"}), 404
+    return jsonify(entry)
+
+
+@app.route("/api/cache-stats")
+def cache_stats():
+    # Counters are per worker process; parallel renders fill the pool's caches.
+    return jsonify({"wrap_text": wrap_cache_stats()})
+
+
+@app.route("/api/profiles/<profile_id>/<name>")
+def get_profile(profile_id, name):
+    """A stored artifact of a profiled request (admins only)."""
+    if not is_admin():
+        return jsonify({"error": "Profiles are restricted to admins"}), 403
+    if not _PROFILE_ID.match(profile_id) or name not in PROFILE_ARTIFACTS:
+        return jsonify({"error": "Profile not found"}), 404
+    path = os.path.join(PROFILES_FOLDER, profile_id, name)
+    if not os.path.exists(path):
+        return jsonify({"error": "Profile not found"}), 404
+    return send_file(path, as_attachment=True, download_name=f"{profile_id}_{name}")
+
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": f"Upload is larger than {MAX_UPLOAD_MB} MB"}), 413
+
+
+@app.before_request
+def refuse_large_uploads():
+    # Routes turn exceptions into 500s, so refuse oversized bodies up front
+    limit = request.max_content_length
+    if limit is not None and request.content_length is not None and request.content_length > limit:
+        return upload_too_large(None)
+
+
+@app.before_request
+def start_background_threads():
+    _ensure_janitor()
+    _ensure_metrics_publisher()
+    _ensure_job_workers()               # also picks up jobs queued by workers that are gone
+
+
+@app.before_request
+def start_first_request_timer():
+    if _startup["first_request"] is None:
+        with _first_request_lock:
+            if _startup["first_request"] is None:
+                _startup["first_request"] = request.endpoint or request.path
+                g.first_request_started = time.perf_counter()
+
+
+@app.after_request
+def record_first_request(response):
+    started = g.pop("first_request_started", None)
+    if started is not None:
+        seconds = time.perf_counter() - started
+        metrics.set("portal_first_request_seconds", seconds, endpoint=_startup["first_request"])
+        log_event("first_request", pid=os.getpid(), endpoint=_startup["first_request"],
+                  status=response.status_code, seconds=round(seconds, 4), warm=_startup["warm_seconds"] is not None)
+    return response
+
+
+@app.route("/api/storage")
+def storage_stats():
+    """Disk usage, the retention settings and this worker's last janitor sweep."""
+    return jsonify({
+        "usage": disk_usage(),
+        "quota_bytes": OUTPUT_QUOTA_MB * 1024 * 1024,
+        "retention_days": RETENTION_DAYS,
+        "workspace_max_age_hours": WORKSPACE_MAX_AGE_HOURS,
+        "last_sweep": {k: v for k, v in _last_sweep.items() if k != "usage"} or None,
+    })
+
+
+@app.route("/api/storage/gc", methods=["POST"])
+def storage_gc():
+    """Run a janitor sweep now (admins only)."""
+    if not is_admin():
+        return jsonify({"error": "Garbage collection is restricted to admins"}), 403
+    return jsonify(sweep_storage())
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    # All workers added up; falls back to this worker alone if the database fails.
+    try:
+        body = collect_metrics()
+    except sqlite3.Error as e:
+        log_event("metrics", level=logging.WARNING, error=str(e))
+        body = metrics.render()
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/bills")
+def find_bills():
+    """Search generated PDFs: ?q=, bill, company, invoice, lr, cn, truck (prefixes),
+    from/to (invoice date), min_total/max_total, limit/offset."""
+    try:
+        limit = min(max(int(request.args.get("limit", 50)), 1), BILL_SEARCH_MAX_LIMIT)
+        offset = max(int(request.args.get("offset", 0)), 0)
+        min_total = request.args.get("min_total", type=float)
+        max_total = request.args.get("max_total", type=float)
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+
+    items, total = search_bills(
+        limit, offset,
+        q=request.args.get("q"),
+        bill=request.args.get("bill"),
+        company_code=request.args.get("company"),
+        refs={kind: request.args.get(kind) for kind, _ in BILL_REF_COLUMNS},
+        since=request.args.get("from"),
+        until=request.args.get("to"),
+        min_total=min_total,
+        max_total=max_total,
+    )
+    for item in items:
+        item["url"] = url_for("get_bill", filename=item["pdf_file"])
+    return jsonify({"items": items, "total": total, "limit": limit, "offset": offset})
 
 
 @app.route("/api/bills/<filename>")
 def get_bill(filename):
+    # Only bill PDFs: not their .sha256 / .gz companions or files being written
+    if not filename.endswith(".pdf") or filename.startswith((".", "_")):
+        return jsonify({"error": "File not found"}), 404
     try:
         file_path = os.path.join(OUTPUT_FOLDER, filename)
-        if os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True, download_name=filename)
+        if os.path.isfile(file_path):
+            record_download(file_path)
+            return send_download(file_path, filename)
         else:
             return jsonify({"error": "File not found"}), 404
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
-# ---------------------------------------------------------------------------
-# PDF generation – dispatch
-# ---------------------------------------------------------------------------
+@app.route("/api/batch", methods=["POST"])
+def generate_batch():
+    """Several workbooks (or ZIPs of them), each with its company, in one archive with a manifest."""
+    timer = RequestTimer("batch")
+    try:
+        with timer.active():
+            workbooks, error = collect_batch_workbooks()
+        if error:
+            return error
+        persist = request.form.get("persist", "1" if PERSIST_PDFS else "0") == "1"
 
-def generate_multiple_pdfs(df, company_code):
-    pdf_files = []
-    grouped = df.groupby('FreightBillNo')
-    for bill_no, group_df in grouped:
-        print(f"  → Generating: {bill_no}")
-        pdf_path = generate_pdf(group_df.reset_index(drop=True), company_code)
-        pdf_files.append(pdf_path)
-    return pdf_files
+        def stream():
+            try:
+                yield from stream_zip(iter_batch_archive(workbooks, persist))
+            except Exception as e:
+                timer.finish("error", level=logging.ERROR, exc_info=True, error=str(e))
+                raise
+            timer.finish("ok", workbooks=len(workbooks))
+
+        return Response(
+            stream(),
+            mimetype="application/zip",
+            headers={"Content-Disposition": f"attachment; filename=Batch_{datetime.now():%Y%m%d_%H%M%S}.zip"}
+        )
 
+    except Exception as e:
+        timer.finish("error", level=logging.ERROR, exc_info=True, error=str(e))
+        return jsonify({"error": str(e)}), 500
 
-def generate_pdf(df, company_code):
-    company = COMPANIES[company_code]
-    if company.get("type") == "transin":
-        return generate_transin_pdf(df, company_code)
-    else:
-        return generate_basic_pdf(df, company_code)
+
+@app.route("/api/jobs", methods=["POST"])
+def create_job():
+    file, token, cached, error = resolve_upload()
+    if error:
+        return error
+
+    company_code = request.form.get("company", "stc")
+
+    if company_code not in COMPANIES:
+        return jsonify({"error": "Invalid company selected"}), 400
+
+    output = request.form.get("output", "zip")
+    if output not in OUTPUT_MODES:
+        return jsonify({"error": f"Unknown output mode: {output}"}), 400
+
+    persist = request.form.get("persist", "1" if PERSIST_PDFS else "0") == "1"
+    timer = RequestTimer("job_submit", company_code)
+    with timer.active():
+        job_id, filename = submit_job(file, token, cached, company_code, persist, output)
+    timer.finish("queued", job_id=job_id, file=filename, cached=cached is not None, output=output)
+    return jsonify({
+        "job_id": job_id,
+        "status_url": url_for("job_status", job_id=job_id),
+        "download_url": url_for("job_download", job_id=job_id)
+    }), 202
+
+
+@app.route("/api/jobs/<job_id>")
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
+@app.route("/api/jobs/<job_id>/download")
+def job_download(job_id):
+    job = get_job(job_id, with_bills=False)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if job["status"] != "done":
+        return jsonify({"error": f"Job is {job['status']}"}), 409
+    record_download(job["result_path"])
+    if job["output"] == "combined":
+        return send_download(job["result_path"], combined_pdf_name(job["company_code"]))
+    return send_download(job["result_path"], f"{job['company_code'].upper()}_Bills.zip")
 
 
 # ---------------------------------------------------------------------------
-# Transin PDF  (fixed layout – compact, dynamic row heights, DN signature)
+# Background jobs – queued in SQLite, claimed by the job threads of any worker
 # ---------------------------------------------------------------------------
 
-def generate_transin_pdf(df, company_code):
-    company = COMPANIES[company_code]
+_job_threads = []
+_job_threads_lock = threading.Lock()
+_job_wakeup = threading.Event()           # set when this worker queues a job
 
-    bill_no = str(df.iloc[0]["FreightBillNo"]).replace("/", "_")
-    pdf_path = f"{OUTPUT_FOLDER}/{company_code}_{bill_no}.pdf"
 
-    c = canvas.Canvas(pdf_path, pagesize=landscape(A4))
-    width, height = landscape(A4)
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    margin = 15
-    c.rect(margin, margin, width - 2 * margin, height - 2 * margin, stroke=1, fill=0)
 
-    # ── Header ──────────────────────────────────────────────────────────────
-    c.setFont("Helvetica-Bold", 14)
-    c.drawCentredString(width / 2, height - 36, company["name"])
+def _ensure_job_workers():
+    """Start the job threads lazily so nothing is spawned before a fork."""
+    with _job_threads_lock:
+        if _job_threads:
+            return
+        for i in range(max(JOB_WORKERS, 1)):
+            t = threading.Thread(target=_job_worker, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            _job_threads.append(t)
 
-    c.setFont("Helvetica", 7.5)
-    c.drawCentredString(width / 2, height - 50, company["address_line1"])
-    c.drawCentredString(width / 2, height - 60, company["address_line2"])
 
-    c.setFont("Helvetica-Bold", 11)
-    c.drawCentredString(width / 2, height - 76, "INVOICE")
+def _job_worker():
+    while True:
+        try:
+            ran = run_next_job()
+        except sqlite3.Error as e:
+            log_event("job_claim", level=logging.WARNING, error=str(e))
+            ran = False
+        if not ran:
+            _job_wakeup.wait(JOB_POLL_INTERVAL)
+            _job_wakeup.clear()
+
+
+def run_next_job():
+    """Claim the oldest queued job and run it; False if nothing was queued."""
+    job = claim_job()
+    if job is None:
+        return False
+    with _job_heartbeat(job["id"], job["owner"]):
+        run_job(job["id"], job["upload_path"], job["token"], job["file"], job["company_code"],
+                bool(job["persist"]), job["output"])
+    return True
+
+
+def requeue_stale_jobs(now=None):
+    """Queue again running jobs whose worker stopped sending heartbeats; fail them after JOB_MAX_ATTEMPTS."""
+    now = time.time() if now is None else now
+    stale = now - JOB_STALE_SECONDS
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', finished = ?, owner = NULL, "
+            "error = 'Job was interrupted too many times' "
+            "WHERE status = 'running' AND (heartbeat IS NULL OR heartbeat < ?) AND attempts >= ?",
+            (_now(), stale, JOB_MAX_ATTEMPTS)
+        )
+        cur = conn.execute(
+            "UPDATE jobs SET status = 'queued', owner = NULL "
+            "WHERE status = 'running' AND (heartbeat IS NULL OR heartbeat < ?)",
+            (stale,)
+        )
+    if cur.rowcount:
+        log_event("job_requeue", jobs=cur.rowcount)
+    return cur.rowcount
+
+
+def _job_owner():
+    """A fresh owner for one claim: host:pid of this worker plus a claim id.
+
+    Built at claim time, not import time: gunicorn --preload imports the app
+    in the master, so every worker would otherwise carry the master's pid.
+    The claim id tells apart two claims of the same job by one worker.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}/{uuid.uuid4().hex[:8]}"
+
+
+def claim_job():
+    """Take the oldest queued job for this worker, or None; the job is marked running."""
+    requeue_stale_jobs()
+    owner = _job_owner()
+    while True:
+        with get_db() as conn:
+            row = conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created, rowid LIMIT 1").fetchone()
+            if row is None:
+                return None
+            cur = conn.execute(
+                "UPDATE jobs SET status = 'running', started = ?, owner = ?, heartbeat = ?, attempts = attempts + 1 "
+                "WHERE id = ? AND status = 'queued'",
+                (_now(), owner, time.time(), row["id"])
+            )
+            if cur.rowcount == 1:             # another thread or worker may have won the race
+                return dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
 
-    c.setFont("Helvetica", 6.5)
-    c.drawCentredString(width / 2, height - 87, "@ This is system generated invoice")
 
-    # ── Left box – Customer ─────────────────────────────────────────────────
-    box_top = height - 100
-    box_h = 72
+def touch_job(job_id, owner):
+    """Refresh the heartbeat of a job owned by this claim; False if the job was requeued since."""
+    with get_db() as conn:
+        cur = conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                           (time.time(), job_id, owner))
+    return cur.rowcount == 1
 
-    c.rect(30, box_top - box_h, 252, box_h, stroke=1, fill=0)
 
-    c.setFont("Helvetica-Bold", 8)
-    c.drawString(38, box_top - 14, "To,")
+@contextmanager
+def _job_heartbeat(job_id, owner):
+    """Keep a claimed job's heartbeat fresh while it runs, so it is not requeued."""
+    stop = threading.Event()
 
-    c.setFont("Helvetica", 7)
-    c.drawString(38, box_top - 26, company["customer"]["name"])
-    c.drawString(38, box_top - 36, company["customer"]["address_line1"])
-    c.drawString(38, box_top - 46, company["customer"]["address_line2"])
-    c.drawString(38, box_top - 58, f"GSTIN: {company['customer']['gstin']}")
+    def beat():
+        while not stop.wait(JOB_STALE_SECONDS / 4):
+            try:
+                if not touch_job(job_id, owner):
+                    log_event("job_heartbeat", level=logging.WARNING, job_id=job_id, owner=owner,
+                              error="claim lost")
+                    return
+            except sqlite3.Error as e:
+                log_event("job_heartbeat", level=logging.WARNING, job_id=job_id, error=str(e))
+
+    thread = threading.Thread(target=beat, name=f"job-heartbeat-{job_id[:8]}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
 
-    # ── Right box – Invoice details ─────────────────────────────────────────
-    c.rect(width - 268, box_top - box_h, 248, box_h, stroke=1, fill=0)
 
-    c.setFont("Helvetica-Bold", 8)
-    c.drawString(width - 260, box_top - 14, f"Freight Bill No: {df.iloc[0]['FreightBillNo']}")
+def submit_job(file, token, cached, company_code, persist=True, output="zip"):
+    """Record a queued job and hand it to the job threads; returns (job_id, filename).
 
-    c.setFont("Helvetica", 7)
-    c.drawString(width - 260, box_top - 28, f"Invoice Date: {df.iloc[0]['InvoiceDate'].strftime('%d %b %Y')}")
-    c.drawString(width - 260, box_top - 40, f"Due Date: {df.iloc[0]['DueDate'].strftime('%d %b %Y')}")
+    The upload is only saved when its parsed sheet is not cached already.
+    """
+    job_id = uuid.uuid4().hex
+    if cached is not None:
+        path = None
+        filename = file.filename if file is not None else cached.attrs.get("filename", f"{token[:12]}.xlsx")
+    else:
+        path = workspace_path(new_workspace(f"job-{job_id}"), file.filename)
+        with stage("upload_save"):
+            file.save(path)
+        filename = file.filename
+
+    with get_db() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, status, file, company_code, created, output, upload_path, token, persist) "
+            "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, filename, company_code, _now(), output, path, token, int(persist))
+        )
 
+    _ensure_job_workers()
+    _job_wakeup.set()
+    return job_id, filename
 
-    # From location
-    c.setFont("Helvetica", 6.5)
-    c.drawString(30, box_top - box_h - 9, f"From location: {df.iloc[0]['FromLocation']}")
 
-    # ── Table ───────────────────────────────────────────────────────────────
-    table_top = box_top - box_h - 20
-    table_left = 30
+def run_job(job_id, path, token, filename, company_code, persist=True, output="zip"):
+    """Generate every bill of an uploaded sheet into JOBS_FOLDER/<job_id>.zip.
 
-    headers = [
-        "S.\nno.", "Shipment\nDate", "LR\nNo.", "Destination", "CN\nNumber",
-        "Truck No", "Invoice No", "Pkgs", "Weight\n(kgs)",
-        "Freight\nAmt (Rs.)", "To Point\nCharges\n(Rs.)", "Unloading\nCharge\n(Rs.)",
-        "Source\nDetention\n(Rs.)", "Destination\nDetention\n(Rs.)", "Total\nAmount\n(Rs.)"
-    ]
+    With output="combined" the bills go into one PDF, JOBS_FOLDER/<job_id>.pdf.
+    The job has been claimed (status running) already; a job run again
+    after its worker died starts over.
+    """
+    with get_db() as conn:
+        conn.execute("DELETE FROM job_bills WHERE job_id = ?", (job_id,))
+        conn.execute("UPDATE jobs SET done_bills = 0, error = NULL WHERE id = ?", (job_id,))
+    timer = RequestTimer("job", company_code)
+    with timer.active():
+        try:
+            sheet = cached_bill_sheet(token)
+            if sheet is None:
+                if path is None:
+                    raise ValueError("Upload expired, please choose the file again")
+                sheet = load_bill_sheet(path)
+                cache_bill_sheet(token, sheet, filename)
+            df = prepare_bills(sheet, company_code)
+            bill_numbers = df['FreightBillNo'].unique().tolist()
+            with get_db() as conn:
+                conn.execute("UPDATE jobs SET rows = ?, total_bills = ? WHERE id = ?",
+                             (len(df), len(bill_numbers), job_id))
+                conn.executemany(
+                    "INSERT INTO job_bills (job_id, seq, bill_no, status) VALUES (?, ?, ?, 'queued')",
+                    [(job_id, seq, str(b)) for seq, b in enumerate(sorted(bill_numbers))]
+                )
+
+            def bill_done(seq, *_):
+                with get_db() as conn:
+                    conn.execute("UPDATE job_bills SET status = 'done' WHERE job_id = ? AND seq = ?",
+                                 (job_id, seq))
+                    conn.execute("UPDATE jobs SET done_bills = done_bills + 1 WHERE id = ?", (job_id,))
+
+            pdf_files = []
+            render_stats = {"reused": 0}
+            if output == "combined":
+                result_path = os.path.join(JOBS_FOLDER, f"{job_id}.pdf")
+                part = f"{result_path}.{uuid.uuid4().hex}.part"
+                write_combined_pdf(iter_bill_groups(df), company_code, part, progress=bill_done)
+            else:
+                result_path = os.path.join(JOBS_FOLDER, f"{job_id}.zip")
+                part = f"{result_path}.{uuid.uuid4().hex}.part"
+                with zipfile.ZipFile(part, 'w') as zipf:
+                    rendered = iter_bill_pdfs(iter_bill_groups(df), company_code, stats=render_stats)
+                    for seq, (name, data) in enumerate(rendered):
+                        with stage("zip"):
+                            zipf.writestr(name, data)
+                        if persist:
+                            pdf_files.append(keep_pdf(name, data, render_stats))
+                        bill_done(seq)
+            # A run per claim writes its own .part, so a run that lost its
+            # claim never interleaves with the one that took the job over.
+            os.replace(part, result_path)
+
+            save_history(make_history_entry(filename, company_code, len(df), bill_numbers, pdf_files,
+                                            reused=render_stats["reused"]))
+            with get_db() as conn:
+                conn.execute(
+                    "UPDATE jobs SET status = 'done', finished = ?, result_path = ?, reused_bills = ? WHERE id = ?",
+                    (_now(), result_path, render_stats["reused"], job_id)
+                )
+            timer.finish("done", job_id=job_id, output=output, file=filename, rows=len(df),
+                         bills=len(bill_numbers), reused=render_stats["reused"])
+
+        except Exception as e:
+            timer.finish("failed", level=logging.ERROR, exc_info=True, job_id=job_id, file=filename, error=str(e))
+            with get_db() as conn:
+                conn.execute("UPDATE jobs SET status = 'failed', finished = ?, error = ? WHERE id = ?",
+                             (_now(), str(e), job_id))
+        finally:
+            if path is not None:
+                remove_workspace(os.path.dirname(path))
+
+
+def get_job(job_id, with_bills=True):
+    """Job status as a dict (per-bill progress included), or None if unknown."""
+    with get_db() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["progress"] = round(job["done_bills"] / job["total_bills"], 4) if job["total_bills"] else 0.0
+        if with_bills:
+            job["bills"] = [
+                {"bill": r["bill_no"], "status": r["status"]}
+                for r in conn.execute(
+                    "SELECT bill_no, status FROM job_bills WHERE job_id = ? ORDER BY seq", (job_id,)
+                )
+            ]
+    return job
 
-    col_widths = [22, 48, 33, 52, 48, 48, 82, 28, 42, 48, 48, 48, 48, 52, 52]
-    total_col_width = sum(col_widths)
 
-    # Header row
-    header_h = 23
-    c.setFillColor(colors.lightgrey)
-    c.rect(table_left, table_top - header_h, total_col_width, header_h, stroke=1, fill=1)
-    c.setFillColor(colors.black)
-    c.setFont("Helvetica-Bold", 5.5)
+# ---------------------------------------------------------------------------
+# Batch generation – many workbooks and companies, one archive
+# ---------------------------------------------------------------------------
 
-    x = table_left
-    for i, header in enumerate(headers):
-        lines = header.split('\n')
-        num_lines = len(lines)
-        y_start = table_top - (header_h - num_lines * 6.5) / 2 - 4.5
-        for j, line in enumerate(lines):
-            c.drawCentredString(x + col_widths[i] / 2, y_start - j * 6.5, line)
-        x += col_widths[i]
+WORKBOOK_EXTENSIONS = (".xlsx", ".xlsm", ".xls")
+
+
+def collect_batch_workbooks():
+    """The (name, company_code, bytes) workbooks of a batch request, or an error.
+
+    Each uploaded "files" entry is a workbook or a ZIP of workbooks.  Its
+    company is the "companies" value at the same position, else the
+    "company" field.  Inside a ZIP, a workbook in a top-level folder named
+    after a company code (stc/march.xlsx) belongs to that company.
+    Returns (workbooks, error) where error is a (response, status) pair.
+    """
+    files = [f for f in request.files.getlist("files") if f.filename]
+    if not files:
+        return None, (jsonify({"error": "No files uploaded"}), 400)
+    companies = request.form.getlist("companies")
+    default_company = request.form.get("company")
+
+    workbook_limit = BATCH_MAX_WORKBOOK_MB * 1024 * 1024
+    total_limit = BATCH_MAX_TOTAL_MB * 1024 * 1024
+    total = 0
+
+    def too_large(name, size):
+        nonlocal total
+        if size > workbook_limit:
+            return jsonify({"error": f"{name} is larger than {BATCH_MAX_WORKBOOK_MB} MB"}), 413
+        total += size
+        if total > total_limit:
+            return jsonify({"error": f"Batch unpacks to more than {BATCH_MAX_TOTAL_MB} MB"}), 413
+        return None
+
+    workbooks = []
+    for i, file in enumerate(files):
+        company_code = companies[i] if i < len(companies) and companies[i] else default_company
+        data = file.read()
+        if file.filename.lower().endswith(".zip"):
+            try:
+                archive = zipfile.ZipFile(io.BytesIO(data))
+            except zipfile.BadZipFile:
+                return None, (jsonify({"error": f"{file.filename} is not a valid ZIP file"}), 400)
+            with archive:
+                for info in archive.infolist():
+                    parts = info.filename.split("/")
+                    if (info.is_dir() or parts[0] == "__MACOSX" or parts[-1].startswith(".")
+                            or not parts[-1].lower().endswith(WORKBOOK_EXTENSIONS)):
+                        continue
+                    inner_company = parts[0] if len(parts) > 1 and parts[0] in COMPANIES else company_code
+                    name = f"{file.filename}/{info.filename}"
+                    # file_size comes from the archive; zipfile refuses to unpack more than it says
+                    error = too_large(name, info.file_size)
+                    if error:
+                        return None, error
+                    workbooks.append((name, inner_company, archive.read(info)))
+                    if len(workbooks) > BATCH_MAX_WORKBOOKS:
+                        break
+        else:
+            error = too_large(file.filename, len(data))
+            if error:
+                return None, error
+            workbooks.append((file.filename, company_code, data))
+        if len(workbooks) > BATCH_MAX_WORKBOOKS:
+            return None, (jsonify({"error": f"At most {BATCH_MAX_WORKBOOKS} workbooks per batch"}), 400)
+
+    if not workbooks:
+        return None, (jsonify({"error": "No workbooks found in the upload"}), 400)
+    for name, company_code, _ in workbooks:
+        if company_code not in COMPANIES:
+            return None, (jsonify({"error": f"Invalid or missing company for {name}"}), 400)
+    return workbooks, None
 
-    # Header vertical lines
-    x = table_left
-    for wv in col_widths:
-        c.line(x, table_top, x, table_top - header_h)
-        x += wv
-    c.line(x, table_top, x, table_top - header_h)
 
-    # ── Data rows (dynamic height, font 7pt) ───────────────────────────────
-    DATA_FONT = 7
-    DATA_LINE_HEIGHT = 8
+def run_batch_workbook(name, company_code, data, persist=True):
+    """Parse and render one workbook of a batch; returns (manifest entry, [(pdf name, bytes)]).
 
-    y = table_top - header_h
-    total_amount = 0
+    Parsed sheets go through the upload cache and bills through the usual
+    fingerprint check, so workbooks seen before cost little.  Failures are
+    reported in the manifest entry instead of raised.
+    """
+    entry = {"workbook": name, "company": company_code, "status": "ok"}
+    timer = RequestTimer("batch_workbook", company_code)
+    with timer.active():
+        try:
+            token = hashlib.sha256(data).hexdigest()
+            sheet = cached_bill_sheet(token)
+            entry["cached"] = sheet is not None
+            if sheet is None:
+                sheet = load_bill_sheet(io.BytesIO(data))
+                cache_bill_sheet(token, sheet, os.path.basename(name))
+            df = prepare_bills(sheet, company_code)
+            bill_numbers = df['FreightBillNo'].unique().tolist()
+
+            pdfs, pdf_files = [], []
+            render_stats = {}
+            for pdf_name, pdf in iter_bill_pdfs(iter_bill_groups(df), company_code, stats=render_stats):
+                if persist:
+                    pdf_files.append(keep_pdf(pdf_name, pdf, render_stats))
+                pdfs.append((pdf_name, pdf))
+            save_history(make_history_entry(os.path.basename(name), company_code, len(df), bill_numbers,
+                                            pdf_files, reused=render_stats["reused"]))
+            entry.update(rows=len(df), bills=[str(b) for b in bill_numbers], reused=render_stats["reused"])
+            timer.finish("ok", file=name, cached=entry["cached"], rows=len(df), bills=len(bill_numbers),
+                         reused=render_stats["reused"])
+            return entry, pdfs
+        except Exception as e:
+            timer.finish("failed", level=logging.ERROR, exc_info=True, file=name, error=str(e))
+            entry.update(status="failed", error=str(e))
+            return entry, []
+
+
+def iter_batch_archive(workbooks, persist=True):
+    """Yield (archive name, bytes) for every PDF of a batch, then manifest.json.
+
+    Workbooks are processed BATCH_WORKERS at a time and written out as each
+    one finishes, every workbook in its own numbered folder.
+    """
+    manifest = []
+    with ThreadPoolExecutor(max_workers=max(BATCH_WORKERS, 1)) as pool:
+        futures = {
+            pool.submit(run_batch_workbook, name, company_code, data, persist): seq
+            for seq, (name, company_code, data) in enumerate(workbooks, 1)
+        }
+        for future in as_completed(futures):
+            seq = futures[future]
+            entry, pdfs = future.result()
+            stem = os.path.splitext(os.path.basename(entry["workbook"]))[0]
+            entry["folder"] = f"{seq:02d}_{secure_filename(stem) or 'workbook'}"
+            entry["pdfs"] = [f"{entry['folder']}/{pdf_name}" for pdf_name, _ in pdfs]
+            manifest.append((seq, entry))
+            for archive_name, (_, pdf) in zip(entry["pdfs"], pdfs):
+                yield archive_name, pdf
+
+    summary = {
+        "workbooks": [entry for _, entry in sorted(manifest, key=lambda item: item[0])],
+        "failed": sum(entry["status"] != "ok" for _, entry in manifest),
+    }
+    yield "manifest.json", json.dumps(summary, indent=2).encode()
 
-    for idx, row in df.iterrows():
-        # Normalise multi-line InvoiceNo (Excel newlines → /)
-        inv_text = str(row["InvoiceNo"]).replace('\n', '/')
-        lr_text = str(row["LRNo"])
 
-        # Count wrapped lines to set dynamic row height
-        c.setFont("Helvetica", DATA_FONT)
-        inv_lines = len(wrap_text_lines(c, inv_text, col_widths[6] - 4, "Helvetica", DATA_FONT))
-        lr_lines = len(wrap_text_lines(c, lr_text, col_widths[2] - 4, "Helvetica", DATA_FONT))
-        max_lines = max(inv_lines, lr_lines, 1)
+# ---------------------------------------------------------------------------
+# Bill preparation – totals and display strings, computed per column once
+# ---------------------------------------------------------------------------
 
-        row_height = max(20, max_lines * DATA_LINE_HEIGHT + 6)   # dynamic: expands for multi-line cells
-        y -= row_height
+def row_totals(df):
+    """Sum of the five charge columns per row (missing columns count as 0)."""
+    total = pd.Series(0.0, index=df.index)
+    for col in AMOUNT_COLUMNS:
+        if col in df.columns:
+            total = total + df[col].astype(float)
+    return total
 
-        row_total = (
-            float(row["FreightAmt"]) +
-            float(row["ToPointCharges"]) +
-            float(row["UnloadingCharge"]) +
-            float(row["SourceDetention"]) +
-            float(row["DestinationDetention"])
-        )
-        total_amount += row_total
-
-        values = [
-            str(idx + 1),
-            row["ShipmentDate"].strftime("%d-%m-%Y"),
-            lr_text,
-            str(row["Destination"]),
-            str(row["CNNumber"]),
-            str(row["TruckNo"]),
-            inv_text,
-            str(int(row["Pkgs"])),
-            str(int(row["WeightKgs"])),
-            f"{float(row['FreightAmt']):.1f}",
-            f"{float(row['ToPointCharges']):.1f}",
-            f"{float(row['UnloadingCharge']):.1f}",
-            f"{float(row['SourceDetention']):.1f}",
-            f"{float(row['DestinationDetention']):.1f}",
-            f"{row_total:.1f}"
-        ]
 
-        # Columns that may wrap: LR No (2) and Invoice No (6)
-        wrap_columns = {2, 6}
+def amount_in_words(amount, round_paise=False):
+    rupees = int(amount)
+    paise = (amount - rupees) * 100
+    paise = int(round(paise)) if round_paise else int(paise)
 
-        x = table_left
-        for i, val in enumerate(values):
-            if i in wrap_columns:
-                draw_wrapped_text(c, val, x + col_widths[i] / 2, y + row_height / 2,
-                                  col_widths[i] - 4, "Helvetica", DATA_FONT, DATA_LINE_HEIGHT)
-            else:
-                c.setFont("Helvetica", DATA_FONT)
-                c.drawCentredString(x + col_widths[i] / 2, y + row_height / 2, val)
-            x += col_widths[i]
+    if paise > 0:
+        return (f"{num2words.num2words(rupees, lang='en_IN').title()} Rupees and "
+                f"{num2words.num2words(paise, lang='en_IN').title()} Paise")
+    return f"{num2words.num2words(rupees, lang='en_IN').title()} Rupees"
 
-        # Horizontal separator
-        c.line(table_left, y, table_left + total_col_width, y)
 
-    # Vertical lines for data area
-    x = table_left
-    for wv in col_widths:
-        c.line(x, table_top - header_h, x, y)
-        x += wv
-    c.line(x, table_top - header_h, x, y)
+def _text(series):
+    return series.astype(object).map(str)
 
-    # ── Total row ───────────────────────────────────────────────────────────
-    total_row_h = 15
-    y -= total_row_h
-    c.rect(table_left, y, total_col_width, total_row_h, stroke=1, fill=0)
 
-    rupees = int(total_amount)
-    paise = int(round((total_amount - rupees) * 100))
+def _fmt(series, spec):
+    return series.astype(float).map(spec.format)
 
-    if paise > 0:
-        total_words = f"{num2words(rupees, lang='en_IN').title()} Rupees and {num2words(paise, lang='en_IN').title()} Paise"
-    else:
-        total_words = f"{num2words(rupees, lang='en_IN').title()} Rupees"
 
-    c.setFont("Helvetica-Bold", 6.5)
-    c.drawString(table_left + 4, y + 4.5, f"Total in words (Rs.) : {total_words} Only")
+def prepare_bills(df, company_code):
+    """Add everything the PDF renderers print, computed column-wise.
 
-    c.setFont("Helvetica-Bold", 7.5)
-    total_col_x = table_left + sum(col_widths[:-1])
-    c.drawCentredString(total_col_x + col_widths[-1] / 2, y + 4.5, f"{total_amount:.1f}")
-    c.line(total_col_x, y, total_col_x, y + total_row_h)
+    Adds RowTotal, Cells (the table row as a tuple of strings, in column
+    order), and per-bill BillTotal, BillTotalText, TotalWords, InvoiceDateText
+    and DueDateText.  Renderers only read these, so an upload is formatted
+    once instead of row by row inside every PDF.
+    """
+    df = df.copy()
+    transin = COMPANIES[company_code].get("type") == "transin"
+    amount_fmt = "{:.1f}" if transin else "{:.2f}"
 
-    # ── Bottom section (per reference layout) ──────────────────────────────
-    # Note line 1 – discrepancy warning
-    note_y = y - 9
-    c.setFont("Helvetica", 6)
-    c.drawString(30, note_y,
-                 'Any changes or discrepancies should be highlighted within 5 working days '
-                 'else it would be considered final. Please send all remittance details to '
-                 '"receivables@onmove.in".')
+    df["RowTotal"] = row_totals(df)
+    serial = _text(df.groupby('FreightBillNo', sort=False).cumcount() + 1)
+    amounts = [_fmt(df[col], amount_fmt) for col in AMOUNT_COLUMNS] + [_fmt(df["RowTotal"], amount_fmt)]
+    pkgs = _text(df["Pkgs"].astype("int64"))
+    weight = _text(df["WeightKgs"].astype("int64"))
 
-    # Note line 2 – GST disclaimer
-    note_y -= 9
-    c.setFont("Helvetica", 6)
-    c.drawString(30, note_y, company.get("gst_note", ""))
+    if transin:
+        columns = [
+            serial,
+            df["ShipmentDate"].dt.strftime("%d-%m-%Y"),
+            _text(df["LRNo"]),
+            _text(df["Destination"]),
+            _text(df["CNNumber"]),
+            _text(df["TruckNo"]),
+            _text(df["InvoiceNo"]).str.replace('\n', '/', regex=False),
+            pkgs,
+            weight,
+            *amounts
+        ]
+    else:
+        columns = [
+            serial,
+            df["ShipmentDate"].dt.strftime("%d %b %Y"),
+            _text(df["LRNo"]),
+            _text(df["Destination"]),
+            _text(df["CNNumber"]),
+            _text(df["TruckNo"]),
+            _text(df["InvoiceNo"]),
+            pkgs,
+            weight,
+            df["DateArrival"].dt.strftime("%d %b %Y"),
+            df["DateDelivery"].dt.strftime("%d %b %Y"),
+            _text(df["TruckType"]),
+            *amounts
+        ]
+    df["Cells"] = list(zip(*(col.fillna("").tolist() for col in columns)))
 
-    # ── Bank-details table (left) + Signature (right) ───────────────────────
-    note_y -= 14                          # gap before table / sig zone
+    # Per-bill aggregates.  Summed in row order, exactly like the old loop.
+    bill_totals = {
+        bill_no: sum(totals.tolist())
+        for bill_no, totals in df.groupby('FreightBillNo', sort=False)["RowTotal"]
+    }
+    bills = df['FreightBillNo']
+    df["BillTotal"] = bills.map(bill_totals)
+    df["BillTotalText"] = bills.map({b: amount_fmt.format(t) for b, t in bill_totals.items()})
+    df["TotalWords"] = bills.map({b: amount_in_words(t, round_paise=transin) for b, t in bill_totals.items()})
+    df["InvoiceDateText"] = df["InvoiceDate"].dt.strftime('%d %b %Y')
+    df["DueDateText"] = df["DueDate"].dt.strftime('%d %b %Y' if transin else '%d-%m-%y')
+    return df
 
-    bank_table_top   = note_y
-    bank_row_h       = 14
-    bank_col1_w      = 130                # label column width
-    bank_col2_w      = 120                # value column width
-    bank_table_left  = 30
 
-    bank_rows = [
-        ("Our PAN No.",          company["bank"]["pan"]),
-        ("Transin GSTIN",        company["bank"]["gstin"]),
-        ("SAC code",             company["bank"]["sac_code"]),
-        ("Transin State Code",   company["bank"]["state_code"]),
-    ]
+# ---------------------------------------------------------------------------
+# PDF generation – dispatch
+# ---------------------------------------------------------------------------
 
-    for i, (label, value) in enumerate(bank_rows):
-        row_y = bank_table_top - (i * bank_row_h)
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+
+def get_pdf_pool():
+    """Process pool shared by all requests, created on first use (and again after discard_pdf_pool).
+
+    Pool processes come from a forkserver, never from a fork of this
+    multi-threaded worker, where a lock held by another thread (logo cache,
+    page layers, logging) would stay locked in the child forever.  The
+    forkserver imports the app and the PDF libraries once, so new pool
+    processes start warm.
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            context = multiprocessing.get_context("forkserver")
+            preload = list(_HEAVY_MODULES)
+            if __name__ != "__main__":
+                preload.append(__name__)
+            context.set_forkserver_preload(preload)
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=context)
+        return _pdf_pool
+
+
+def discard_pdf_pool(pool, reason):
+    """Drop a pool that lost a process or hung, so the next get_pdf_pool() starts a fresh one.
+
+    A ProcessPoolExecutor whose child died refuses every later submit, and
+    a render stuck past PDF_RENDER_TIMEOUT keeps its slot; either way the
+    pool is of no more use.  Its processes exit once their current render
+    ends.
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    log_event("pdf_pool", level=logging.WARNING, result="discarded", reason=reason)
+    metrics.inc("portal_pdf_pool_restarts_total", reason=reason)
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_bill_groups(df):
+    """Yield (bill_no, rows) per FreightBillNo, in sorted bill order."""
+    for bill_no, group_df in df.groupby('FreightBillNo'):
+        yield bill_no, group_df.reset_index(drop=True)
+
+
+def iter_bill_pdfs(groups, company_code, workers=None, stats=None):
+    """Render each (bill_no, rows) group and yield (filename, pdf_bytes) in input order.
+
+    Small uploads (fewer than PDF_PARALLEL_MIN_BILLS bills) and workers <= 1
+    render serially in this process; otherwise bills are sent to the process
+    pool with a bounded number in flight, so results still come back in order.
+    Bills lost to a pool process that crashed or hung past PDF_RENDER_TIMEOUT
+    are rendered in this process instead, and the pool is replaced.
+
+    A bill whose fingerprint matches the one stored beside its PDF in
+    OUTPUT_FOLDER is read back instead of rendered.  stats, if given, counts
+    those in "reused", maps each freshly rendered file name to its
+    fingerprint in "fingerprints" and every file name to its bill index
+    entry in "index" (see keep_pdf).
+    """
+    workers = PDF_WORKERS if workers is None else workers
+    stats = {} if stats is None else stats
+    stats.setdefault("reused", 0)
+    fingerprints = stats.setdefault("fingerprints", {})
+    index = stats.setdefault("index", {})
+    company_fp = company_fingerprint(company_code)
+    groups = iter(groups)
+
+    def jobs():
+        # (bill_no, rows, filename, pdf bytes if unchanged else None)
+        for bill_no, group_df in chain(head, groups):
+            if "Cells" not in group_df.columns:
+                group_df = prepare_bills(group_df, company_code)
+            name = pdf_filename(group_df, company_code)
+            index[name] = bill_index_entry(group_df, company_code)
+            fingerprint = bill_fingerprint(group_df, company_fp)
+            data = reusable_pdf(name, fingerprint)
+            if data is not None:
+                log_event("bill", level=logging.DEBUG, company=company_code, bill=str(bill_no), result="reused")
+                metrics.inc("portal_bills_total", company=company_code, result="reused")
+                stats["reused"] += 1
+            else:
+                fingerprints[name] = fingerprint
+            yield group_df, name, data
+
+    def rendered(result):
+        # Render times are measured where the bill was drawn and recorded here.
+        name, data, seconds = result
+        if seconds is not None:
+            record_stage("render", seconds)
+            metrics.inc("portal_bills_total", company=company_code, result="rendered")
+            log_event("bill", level=logging.DEBUG, company=company_code, file=name, result="rendered",
+                      seconds=round(seconds, 4))
+        return name, data
+
+    head = []
+    if workers > 1:
+        for item in groups:
+            head.append(item)
+            if len(head) >= PDF_PARALLEL_MIN_BILLS:
+                break
+
+    if workers <= 1 or len(head) < PDF_PARALLEL_MIN_BILLS:
+        for group_df, name, data in jobs():
+            yield rendered((name, data, None) if data is not None else timed_render(group_df, company_code))
+        return
+
+    def result(entry):
+        # (filename, pdf bytes, seconds) of the oldest bill in flight.  If its
+        # pool broke or hung, the pool is discarded and every bill it still
+        # owed is rendered here instead; later bills go to a fresh pool.
+        future, group_df, pool = entry
+        if future is None:
+            return timed_render(group_df, company_code)
+        try:
+            return future.result(timeout=PDF_RENDER_TIMEOUT)
+        except CancelledError:              # another request discarded the pool
+            pass
+        except (BrokenProcessPool, TimeoutError) as e:
+            discard_pdf_pool(pool, "broken" if isinstance(e, BrokenProcessPool) else "timeout")
+        for i, (other, other_df, other_pool) in enumerate(pending):
+            if other_pool is pool and not (other.done() and not other.cancelled() and other.exception() is None):
+                pending[i] = (None, other_df, None)
+        return timed_render(group_df, company_code)
+
+    pending = deque()
+    try:
+        for group_df, name, data in jobs():
+            if data is not None:
+                future = Future()
+                future.set_result((name, data, None))
+                pending.append((future, group_df, None))
+            else:
+                pool = get_pdf_pool()
+                try:
+                    future = pool.submit(timed_render, group_df, company_code)
+                except BrokenProcessPool:
+                    discard_pdf_pool(pool, "broken")
+                    pool = get_pdf_pool()
+                    future = pool.submit(timed_render, group_df, company_code)
+                pending.append((future, group_df, pool))
+            if len(pending) >= workers * 2:
+                yield rendered(result(pending.popleft()))
+        while pending:
+            yield rendered(result(pending.popleft()))
+    finally:
+        for future, _, _ in pending:
+            if future is not None:
+                future.cancel()
+
+
+def generate_multiple_pdfs(df, company_code, workers=None):
+    """Render every changed bill in df and persist it; returns the PDF paths."""
+    stats = {}
+    return [keep_pdf(name, data, stats)
+            for name, data in iter_bill_pdfs(iter_bill_groups(df), company_code, workers, stats)]
+
+
+def bill_pdf_name(bill_no, company_code):
+    return f"{company_code}_{str(bill_no).replace('/', '_')}.pdf"
+
+
+def pdf_filename(df, company_code):
+    return bill_pdf_name(df.iloc[0]["FreightBillNo"], company_code)
+
+
+def render_pdf(df, company_code):
+    """Render one bill into memory; returns (filename, pdf_bytes)."""
+    if "Cells" not in df.columns:
+        df = prepare_bills(df, company_code)
+    buf = io.BytesIO()
+    company = COMPANIES[company_code]
+    if company.get("type") == "transin":
+        generate_transin_pdf(df, company_code, buf)
+    else:
+        generate_basic_pdf(df, company_code, buf)
+    return pdf_filename(df, company_code), buf.getvalue()
+
+
+def timed_render(df, company_code):
+    """render_pdf plus its wall time: (filename, pdf_bytes, seconds)."""
+    start = time.perf_counter()
+    name, data = render_pdf(df, company_code)
+    return name, data, time.perf_counter() - start
+
+
+def combined_pdf_name(company_code):
+    return f"{company_code.upper()}_Bills.pdf"
+
+
+def write_combined_pdf(groups, company_code, out, progress=None):
+    """Draw every (bill_no, rows) group into one multi-page PDF at out (path or file).
+
+    All bills share a canvas, so the static page layers and the logo are
+    embedded once.  Each bill starts on a new page with an outline entry.
+    progress(seq, bill_no), if given, is called after each bill.  Returns
+    the number of bills written.
+    """
+    company = COMPANIES[company_code]
+    draw = draw_transin_bill if company.get("type") == "transin" else draw_basic_bill
+    c = canvas.Canvas(out, pagesize=PAGE_SIZE)
+    c.setTitle(f"{company['name']} – Freight Bills")
+    seq = -1
+    for seq, (bill_no, group_df) in enumerate(groups):
+        if "Cells" not in group_df.columns:
+            group_df = prepare_bills(group_df, company_code)
+        start = time.perf_counter()
+        key = f"bill{seq}"
+        c.bookmarkPage(key)
+        c.addOutlineEntry(str(bill_no), key, level=0)
+        draw(c, group_df, company_code)
+        c.showPage()
+        record_stage("render", time.perf_counter() - start)
+        metrics.inc("portal_bills_total", company=company_code, result="rendered")
+        if progress is not None:
+            progress(seq, bill_no)
+    c.showOutline()
+    c.save()
+    return seq + 1
+
+
+def persist_pdf(name, data, fingerprint=None):
+    """Write a rendered PDF to OUTPUT_FOLDER so /api/bills can serve it.
+
+    Both files are published atomically, so concurrent requests never see a
+    half-written PDF.  The fingerprint, if given, is stored beside it in
+    <name>.sha256 together with the PDF's own hash; if two requests write
+    the same bill at once, reusable_pdf notices a sidecar that does not
+    match the PDF and renders again.
+    """
+    pdf_path = os.path.join(OUTPUT_FOLDER, name)
+    try:
+        os.remove(pdf_path + ".sha256")
+    except FileNotFoundError:
+        pass
+    atomic_write(pdf_path, data)
+    if fingerprint:
+        atomic_write(pdf_path + ".sha256", f"{fingerprint} {hashlib.sha256(data).hexdigest()}".encode())
+    return pdf_path
+
+
+def keep_pdf(name, data, stats):
+    """persist_pdf for iter_bill_pdfs output; reused bills are already on disk.
+
+    Either way the bill's entry in the bill index is brought up to date.
+    """
+    fingerprint = stats["fingerprints"].pop(name, None)
+    if fingerprint is None:
+        pdf_path = os.path.join(OUTPUT_FOLDER, name)
+    else:
+        pdf_path = persist_pdf(name, data, fingerprint)
+    entry = stats["index"].pop(name, None)
+    if entry is not None:
+        index_bill(name, entry)
+    return pdf_path
+
+
+def generate_pdf(df, company_code):
+    return generate_multiple_pdfs(df, company_code, workers=1)[0]
+
+
+# ---------------------------------------------------------------------------
+# Bill fingerprints – skip re-rendering bills that have not changed
+# ---------------------------------------------------------------------------
+
+# Part of every fingerprint; bump whenever the PDF layout code changes so
+# existing PDFs are rendered again.
+RENDERER_VERSION = "1"
+
+# Bill-level columns printed on the PDF, besides the table rows in Cells.
+_FINGERPRINT_COLUMNS = ["FreightBillNo", "FromLocation", "BillTotalText", "TotalWords",
+                        "InvoiceDateText", "DueDateText"]
+
+
+def company_fingerprint(company_code):
+    """Renderer version, company config and logo file, hashed."""
+    company = COMPANIES[company_code]
+    try:
+        st = os.stat(company["logo"])
+        logo = (st.st_mtime_ns, st.st_size)
+    except (KeyError, OSError):
+        logo = None
+    payload = json.dumps([RENDERER_VERSION, company_code, company, logo], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def bill_fingerprint(df, company_fp):
+    """Hash of everything printed on one prepared bill."""
+    first = df.iloc[0]
+    payload = repr((company_fp, [str(first[col]) for col in _FINGERPRINT_COLUMNS], df["Cells"].tolist()))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def reusable_pdf(name, fingerprint):
+    """The PDF already in OUTPUT_FOLDER under name, if it was rendered from fingerprint."""
+    pdf_path = os.path.join(OUTPUT_FOLDER, name)
+    try:
+        with open(pdf_path + ".sha256") as f:
+            stored = f.read().split()
+        if not stored or stored[0] != fingerprint:
+            return None
+        with open(pdf_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    # Sidecars written before the PDF hash was added hold the fingerprint only.
+    if len(stored) > 1 and hashlib.sha256(data).hexdigest() != stored[1]:
+        return None
+    return data
+
+
+# ---------------------------------------------------------------------------
+# Bill index – searchable metadata of every PDF kept in OUTPUT_FOLDER
+# ---------------------------------------------------------------------------
+
+# Reference numbers searchable by prefix, as (kind, column).  A cell may list
+# several numbers, one per line.
+BILL_REF_COLUMNS = [("invoice", "InvoiceNo"), ("lr", "LRNo"), ("cn", "CNNumber"), ("truck", "TruckNo")]
+
+# Largest page /api/bills returns.
+BILL_SEARCH_MAX_LIMIT = 200
+
+
+def _iso_day(value):
+    return value.strftime("%Y-%m-%d") if pd.notna(value) else None
+
+
+def bill_index_entry(df, company_code):
+    """Index fields of one prepared bill (output of prepare_bills)."""
+    first = df.iloc[0]
+    shipments = df["ShipmentDate"].dropna() if "ShipmentDate" in df.columns else df.iloc[:0]
+    refs = set()
+    for kind, col in BILL_REF_COLUMNS:
+        if col in df.columns:
+            for cell in _text(df[col].dropna()):
+                refs.update((kind, v.strip()) for v in cell.split('\n') if v.strip())
+    return {
+        "company_code": company_code,
+        "bill_no": str(first["FreightBillNo"]),
+        "invoice_date": _iso_day(first["InvoiceDate"]),
+        "due_date": _iso_day(first["DueDate"]),
+        "first_shipment": _iso_day(shipments.min()) if len(shipments) else None,
+        "last_shipment": _iso_day(shipments.max()) if len(shipments) else None,
+        "total": float(first["BillTotal"]),
+        "rows": len(df),
+        "refs": sorted(refs),
+    }
+
+
+def index_bill(pdf_file, entry):
+    """Insert or replace one PDF's index entry and its reference numbers."""
+    with get_db() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO bills (pdf_file, company_code, bill_no, invoice_date, due_date, "
+            "first_shipment, last_shipment, total, rows, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (pdf_file, entry["company_code"], entry["bill_no"], entry["invoice_date"], entry["due_date"],
+             entry["first_shipment"], entry["last_shipment"], entry["total"], entry["rows"], _now())
+        )
+        conn.execute("DELETE FROM bill_refs WHERE pdf_file = ?", (pdf_file,))
+        conn.executemany(
+            "INSERT INTO bill_refs (pdf_file, kind, value) VALUES (?, ?, ?)",
+            [(pdf_file, kind, value) for kind, value in entry["refs"]]
+        )
+
+
+def _prefix(column, value):
+    """A prefix match on an indexed column, as (sql, params)."""
+    return f"{column} >= ? AND {column} < ?", [value, value + "\uffff"]
+
+
+def search_bills(limit=50, offset=0, q=None, bill=None, company_code=None, refs=None,
+                 since=None, until=None, min_total=None, max_total=None):
+    """Indexed bills matching every filter, sorted by bill number, and the total that match.
+
+    bill and the refs values ({kind: prefix}, kinds from BILL_REF_COLUMNS)
+    match by prefix; q matches a bill number or any reference number by
+    prefix.  since/until bound the invoice date ('YYYY-MM-DD') and
+    min_total/max_total the bill total.
+    """
+    where, params = [], []
+    if company_code:
+        where.append("company_code = ?")
+        params.append(company_code)
+    if bill:
+        sql, args = _prefix("bill_no", bill)
+        where.append(sql)
+        params += args
+    for kind, value in (refs or {}).items():
+        if value:
+            sql, args = _prefix("value", value)
+            where.append(f"pdf_file IN (SELECT pdf_file FROM bill_refs WHERE kind = ? AND {sql})")
+            params += [kind] + args
+    if q:
+        bill_sql, bill_args = _prefix("bill_no", q)
+        ref_sql, ref_args = _prefix("value", q)
+        where.append(f"({bill_sql} OR pdf_file IN (SELECT pdf_file FROM bill_refs WHERE {ref_sql}))")
+        params += bill_args + ref_args
+    if since:
+        where.append("invoice_date >= ?")
+        params.append(since)
+    if until:
+        where.append("invoice_date <= ?")
+        params.append(until)
+    if min_total is not None:
+        where.append("total >= ?")
+        params.append(min_total)
+    if max_total is not None:
+        where.append("total <= ?")
+        params.append(max_total)
+    clause = f"WHERE {' AND '.join(where)}" if where else ""
+
+    with get_db() as conn:
+        total = conn.execute(f"SELECT COUNT(*) FROM bills {clause}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT * FROM bills {clause} ORDER BY bill_no, company_code LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        ).fetchall()
+        items = []
+        for row in rows:
+            item = dict(row)
+            for kind, _ in BILL_REF_COLUMNS:
+                item[kind] = []
+            for ref in conn.execute("SELECT kind, value FROM bill_refs WHERE pdf_file = ? ORDER BY value",
+                                    (row["pdf_file"],)):
+                item[ref["kind"]].append(ref["value"])
+            items.append(item)
+    return items, total
+
+
+# ---------------------------------------------------------------------------
+# Downloads – strong ETags, conditional and range requests, gzip copies
+# ---------------------------------------------------------------------------
+
+# Content hash by path, valid while (mtime_ns, size) is unchanged
+_etags = {}
+_ETAG_CACHE_SIZE = 4096
+
+
+def content_etag(path):
+    """Strong ETag of a file: its SHA-256, hashed once per version of the file.
+
+    Bills persisted with a fingerprint already carry their hash in the
+    .sha256 sidecar, so only job results are ever read to hash them.
+    """
+    st = os.stat(path)
+    version = (st.st_mtime_ns, st.st_size)
+    cached = _etags.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    digest = None
+    try:
+        with open(path + ".sha256") as f:
+            stored = f.read().split()
+        if len(stored) > 1 and os.stat(path + ".sha256").st_mtime_ns >= st.st_mtime_ns:
+            digest = stored[1]
+    except OSError:
+        pass
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+
+    if len(_etags) >= _ETAG_CACHE_SIZE:
+        _etags.clear()
+    _etags[path] = (version, digest[:40])
+    return digest[:40]
+
+
+def gzip_copy(path):
+    """<path>.gz, compressed on first use and again whenever path changes."""
+    gz_path = path + ".gz"
+    try:
+        if os.stat(gz_path).st_mtime_ns >= os.stat(path).st_mtime_ns:
+            return gz_path
+    except FileNotFoundError:
+        pass
+    tmp = f"{gz_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(path, 'rb') as src, gzip.GzipFile(tmp, 'wb', compresslevel=6, mtime=0) as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        os.replace(tmp, gz_path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return gz_path
+
+
+def send_download(path, download_name):
+    """send_file for generated bills and archives, cheap to fetch again.
+
+    Responses carry a content-hash ETag and Last-Modified and must be
+    revalidated, so a repeat download is a 304.  Range and If-Range are
+    answered with partial content, which lets interrupted ZIP downloads
+    resume.  Range requests always get the file as stored, never gzip.
+    """
+    path = os.path.abspath(path)
+    etag = content_etag(path)
+    last_modified = os.path.getmtime(path)
+    body, encoding = path, None
+    if PRECOMPRESS_DOWNLOADS and request.range is None and request.accept_encodings["gzip"]:
+        gz_path = gzip_copy(path)
+        if os.path.getsize(gz_path) < os.path.getsize(path):
+            body, encoding, etag = gz_path, "gzip", etag + "-gzip"
+    response = send_file(body, as_attachment=True, download_name=download_name,
+                         etag=etag, last_modified=last_modified, conditional=True)
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+# ---------------------------------------------------------------------------
+# Storage janitor – retention, quota and garbage collection
+# ---------------------------------------------------------------------------
+
+_WORKSPACE_DIR = re.compile(r"^(req|preview|job-[0-9a-f]{32})-")
+_last_sweep = {}
+
+
+def record_download(path):
+    """Note a download so the janitor evicts least recently downloaded files first."""
+    try:
+        with get_db() as conn:
+            conn.execute(
+                "INSERT INTO file_access (path, last_access, downloads) VALUES (?, ?, 1) "
+                "ON CONFLICT (path) DO UPDATE SET last_access = excluded.last_access, downloads = downloads + 1",
+                (os.path.normpath(path), time.time())
+            )
+    except sqlite3.Error as e:
+        log_event("file_access", level=logging.WARNING, path=path, error=str(e))
+
+
+def _tree_size(path):
+    """(bytes, files) under a directory, or of a single file."""
+    if not os.path.isdir(path):
+        try:
+            return os.stat(path).st_size, 1
+        except OSError:
+            return 0, 0
+    size = files = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.stat(os.path.join(root, name)).st_size
+                files += 1
+            except OSError:
+                pass
+    return size, files
+
+
+def disk_usage():
+    """Bytes and file counts of the portal's storage areas."""
+    areas = {
+        "output": OUTPUT_FOLDER,
+        "jobs": JOBS_FOLDER,
+        "profiles": PROFILES_FOLDER,
+        "uploads": UPLOAD_FOLDER,
+        "parse_cache": PARSE_CACHE_FOLDER,
+    }
+    usage = {}
+    for area, path in areas.items():
+        size, files = _tree_size(path)
+        usage[area] = {"bytes": size, "files": files}
+    return usage
+
+
+def _remove(path):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _output_items(last_access):
+    """Evictable things in output/ as dicts: kind, key, paths, size and last use."""
+    items = []
+
+    def add(kind, key, paths):
+        stats = [os.stat(p) for p in paths if os.path.exists(p)]
+        if stats:
+            used = max([st.st_mtime for st in stats] + [last_access.get(os.path.normpath(paths[0]), 0)])
+            items.append({"kind": kind, "key": key, "paths": paths,
+                          "size": sum(_tree_size(p)[0] for p in paths), "used": used})
+
+    with os.scandir(OUTPUT_FOLDER) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith(".pdf"):
+                add("bill", entry.name, [entry.path, entry.path + ".sha256", entry.path + ".gz"])
+    with os.scandir(JOBS_FOLDER) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith((".zip", ".pdf")):
+                add("job", entry.path, [entry.path, entry.path + ".gz"])
+    with os.scandir(PROFILES_FOLDER) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                add("profile", entry.name, [entry.path])
+    return items
+
+
+def _forget(conn, item):
+    """Drop database references to an evicted item."""
+    if item["kind"] == "bill":
+        conn.execute("DELETE FROM bill_refs WHERE pdf_file = ?", (item["key"],))
+        conn.execute("DELETE FROM bills WHERE pdf_file = ?", (item["key"],))
+        conn.execute("UPDATE history_bills SET pdf_file = NULL WHERE pdf_file = ?", (item["key"],))
+    elif item["kind"] == "job":
+        conn.execute("UPDATE jobs SET status = 'expired', result_path = NULL WHERE result_path = ?",
+                     (item["key"],))
+    conn.execute("DELETE FROM file_access WHERE path = ?", (os.path.normpath(item["paths"][0]),))
+
+
+def sweep_storage(now=None):
+    """One janitor pass: stale temp files and workspaces, then retention and quota in output/.
+
+    Returns a summary with the disk usage after the sweep.
+    """
+    now = time.time() if now is None else now
+    stale_before = now - WORKSPACE_MAX_AGE_HOURS * 3600
+    summary = {"time": _now(), "temp_removed": 0, "evicted": 0, "freed_bytes": 0}
+
+    with get_db() as conn:
+        last_access = {row["path"]: row["last_access"] for row in conn.execute("SELECT * FROM file_access")}
+        protected = {
+            row["pdf_file"] for row in conn.execute(
+                "SELECT pdf_file FROM history_bills WHERE pdf_file IS NOT NULL AND history_id IN "
+                "(SELECT id FROM history ORDER BY time DESC, id DESC LIMIT ?)", (HISTORY_PROTECT_RUNS,)
+            )
+        }
+        active_jobs = {row["id"] for row in conn.execute("SELECT id FROM jobs WHERE status IN ('queued', 'running')")}
+
+    # Leftovers of crashed requests: temp files, parts and workspaces
+    for folder in (OUTPUT_FOLDER, JOBS_FOLDER, PARSE_CACHE_FOLDER):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if (entry.is_file() and entry.name.endswith((".tmp", ".part"))
+                        and entry.stat().st_mtime < stale_before and _remove(entry.path)):
+                    summary["temp_removed"] += 1
+    with os.scandir(UPLOAD_FOLDER) as entries:
+        for entry in entries:
+            if entry.path == os.path.normpath(PARSE_CACHE_FOLDER) or entry.stat().st_mtime >= stale_before:
+                continue
+            match = _WORKSPACE_DIR.match(entry.name) if entry.is_dir() else None
+            if match and match.group(1)[4:] in active_jobs:
+                continue
+            # Workspaces, and uploads saved under their client name by older versions
+            if (match or entry.is_file()) and _remove(entry.path):
+                summary["temp_removed"] += 1
+
+    # Retention, then quota – least recently used first
+    items = sorted(_output_items(last_access), key=lambda item: item["used"])
+    total = sum(item["size"] for item in items)
+    quota = OUTPUT_QUOTA_MB * 1024 * 1024
+    expire_before = now - RETENTION_DAYS * 86400
+    for item in items:
+        if item["kind"] == "bill" and item["key"] in protected:
+            continue
+        if item["used"] >= expire_before and total <= quota:
+            continue
+        if item["used"] > now - 3600:
+            continue                        # written or downloaded within the last hour
+        with get_db() as conn:
+            _forget(conn, item)
+        for path in item["paths"]:
+            _remove(path)
+        total -= item["size"]
+        summary["evicted"] += 1
+        summary["freed_bytes"] += item["size"]
+
+    _trim_parse_cache()
+    summary["usage"] = disk_usage()
+    _last_sweep.clear()
+    _last_sweep.update(summary)
+    log_event("janitor", **{k: v for k, v in summary.items() if k != "usage"})
+    return summary
+
+
+def _claim_sweep(now):
+    """True for the one worker whose turn it is to sweep."""
+    with get_db() as conn:
+        cur = conn.execute("UPDATE janitor SET last_run = ? WHERE id = 1 AND last_run <= ?",
+                           (now, now - JANITOR_INTERVAL))
+        return cur.rowcount == 1
+
+
+def _janitor():
+    while True:
+        try:
+            if _claim_sweep(time.time()):
+                sweep_storage()
+        except Exception as e:
+            log_event("janitor", level=logging.ERROR, exc_info=True, status="failed", error=str(e))
+        time.sleep(min(JANITOR_INTERVAL, 60))
+
+
+_janitor_thread = None
+_janitor_lock = threading.Lock()
+
+
+def _ensure_janitor():
+    """Start the janitor thread lazily so nothing is spawned before a fork."""
+    global _janitor_thread
+    if _janitor_thread is not None or JANITOR_INTERVAL <= 0:
+        return
+    with _janitor_lock:
+        if _janitor_thread is None:
+            _janitor_thread = threading.Thread(target=_janitor, name="janitor", daemon=True)
+            _janitor_thread.start()
+
+
+# ---------------------------------------------------------------------------
+# Static page layers – company chrome recorded once, stamped as a form XObject
+# ---------------------------------------------------------------------------
+
+PAGE_SIZE = landscape(A4)
+
+_FONT_REF = re.compile(r"^BT (/F\d+) ")
+_PDF_STRING = re.compile(r"\((?:\\.|[^\\)])*\)")
+# Operators that name a resource other than a font (XObjects, graphics
+# states, shadings, patterns, colour spaces) or a name of any kind.
+_OTHER_RESOURCE = re.compile(r"/\w|\b(?:Do|gs|sh|cs|CS|scn|SCN)\b")
+
+
+# ReportLab releases (major.minor) the replay below is known to work with:
+# tests/test_static_layers.py checks it gives the same PDFs as drawing.  On
+# any other release the layers are drawn through the public API, so a
+# change to the internals it reads cannot go unnoticed.
+_REPLAY_REPORTLAB = ("5.0",)
+
+
+def _replay_supported():
+    return ".".join(reportlab.Version.split(".")[:2]) in _REPLAY_REPORTLAB
+
+
+def _replayable(code):
+    """True if every resource the operators use is a font set as 'BT /Fn ...'."""
+    for op in code:
+        op = _PDF_STRING.sub("()", _FONT_REF.sub("BT ", op))
+        if _OTHER_RESOURCE.search(op):
+            return False
+    return True
+
+
+class StaticLayer:
+    """The fixed part of a company's page, recorded once per process.
+
+    ReportLab forms belong to a single document, so the operator stream is
+    captured from a scratch canvas and replayed into a form XObject on each
+    bill's canvas, with font references remapped to that document.  That
+    relies on ReportLab internals (the canvas operator list and the
+    document font mapping), so it is only done on the ReportLab releases
+    in _REPLAY_REPORTLAB.  On other releases, or if the recorded stream
+    uses anything but fonts, the layer is drawn into the form through the
+    public API once per document instead.
+    tests/test_static_layers.py checks both give identical PDFs.
+    """
+
+    def __init__(self, draw, company_code, lowery=0):
+        self.draw = draw
+        self.company_code = company_code
+        self.lowery = lowery
+        self.code = None
+        if not _replay_supported():
+            log_event("static_layer", level=logging.WARNING, company=company_code, draw=draw.__name__,
+                      result="drawn per document", reportlab=reportlab.Version)
+            return
+        scratch = canvas.Canvas(io.BytesIO(), pagesize=PAGE_SIZE)
+        draw(scratch, company_code)
+        try:
+            code = list(scratch._code)
+            fonts = {ref: font for font, ref in scratch._doc.fontMapping.items()}
+            # Colour calls raise the PDF version (alpha) even when they emit nothing
+            pdf_version = scratch._doc._pdfVersion
+            scratch._doc.getInternalFontName
+        except AttributeError:
+            code = None
+        if code is not None and _replayable(code):
+            self.code, self.fonts, self.pdf_version = code, fonts, pdf_version
+        else:
+            log_event("static_layer", level=logging.WARNING, company=company_code, draw=draw.__name__,
+                      result="drawn per document")
+
+    def stamp(self, c, name, dy=0):
+        """Draw the layer on c, shifted down/up by dy; defines the form once per document."""
+        if not c.hasForm(name):
+            width, height = PAGE_SIZE
+            c.beginForm(name, lowerx=0, lowery=self.lowery, upperx=width, uppery=height)
+            if self.code is None:
+                self.draw(c, self.company_code)
+            else:
+                refs = {ref: c._doc.getInternalFontName(font) for ref, font in self.fonts.items()}
+                c._doc._pdfVersion = max(c._doc._pdfVersion, self.pdf_version)
+                c._code.extend(_FONT_REF.sub(lambda m: f"BT {refs[m.group(1)]} ", op) for op in self.code)
+            c.endForm()
+        if dy:
+            c.saveState()
+            c.translate(0, dy)
+            c.doForm(name)
+            c.restoreState()
+        else:
+            c.doForm(name)
+
+
+_static_layers = {}
+_static_layers_lock = threading.Lock()
+
+
+def stamp_static(c, company_code, part, dy=0):
+    """Stamp the 'top' (page chrome) or 'bottom' (notes, bank, signature) layer."""
+    key = (company_code, part)
+    layer = _static_layers.get(key)
+    if layer is None:
+        with _static_layers_lock:
+            layer = _static_layers.get(key)
+            if layer is None:
+                kind = "transin" if COMPANIES[company_code].get("type") == "transin" else "basic"
+                draw = _STATIC_DRAWERS[(kind, part)]
+                # Bottom layers are drawn relative to y=0 and shifted into place.
+                layer = StaticLayer(draw, company_code, lowery=-PAGE_SIZE[1] if part == "bottom" else 0)
+                _static_layers[key] = layer
+    layer.stamp(c, f"{company_code}_{part}", dy)
+
+
+_logo_cache = {}
+_logo_cache_lock = threading.Lock()
+
+
+def get_logo(path, width, height):
+    """Decoded logo as a reusable ImageReader, or None if missing/unreadable.
+
+    Each file is verified and decoded once, shrunk to fit width x height
+    points at LOGO_DPI, and reloaded only when its mtime changes.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    key = (path, width, height)
+    with _logo_cache_lock:
+        cached = _logo_cache.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    try:
+        with Image.open(path) as img:
+            img.verify()
+        img = Image.open(path)
+        img.thumbnail((round(width / 72 * LOGO_DPI), round(height / 72 * LOGO_DPI)))
+        reader = rl_utils.ImageReader(img)
+    except Exception as e:
+        log_event("logo", level=logging.WARNING, path=path, error=str(e))
+        reader = None
+
+    with _logo_cache_lock:
+        _logo_cache[key] = (mtime, reader)
+    return reader
+
+
+# ---------------------------------------------------------------------------
+# Table layout – streaming pagination of data rows
+# ---------------------------------------------------------------------------
+
+PAGE_BOTTOM = 30        # lowest y a row, carry row or footer may reach
+
+
+def layout_rows(rows, top, bottom, carry_h, tail_h):
+    """Place (height, payload) rows top-down, breaking pages as they fill.
+
+    Rows are pulled lazily, so only the current row is ever measured and
+    held. Yields:
+      ("row", payload, y, height)  – draw the row with its bottom edge at y
+      ("break", y)                 – page is full below y: draw the
+                                     carried-forward row under y, start a new
+                                     page and draw the brought-forward row
+                                     under top; layout resumes at top - carry_h
+      ("end", y)                   – last row ends at y with tail_h (total row
+                                     and footer) of room left beneath it
+    Every page keeps carry_h free above bottom for its carried-forward row.
+    A row taller than a whole page is placed anyway rather than looping.
+    """
+    y = page_top = top
+    for height, payload in rows:
+        if y - height < bottom + carry_h and y != page_top:
+            yield ("break", y)
+            y = page_top = top - carry_h
+        y -= height
+        yield ("row", payload, y, height)
+    if y - tail_h < bottom and y != page_top:
+        yield ("break", y)
+        y = top - carry_h
+    yield ("end", y)
+
+
+def draw_carry_row(c, label, amount, y, row_h, table_left, col_widths, font_size):
+    """A full-width 'Carried forward' / 'Brought forward' row with the running subtotal."""
+    total_col_width = sum(col_widths)
+    total_col_x = table_left + sum(col_widths[:-1])
+    c.rect(table_left, y, total_col_width, row_h, stroke=1, fill=0)
+    c.line(total_col_x, y, total_col_x, y + row_h)
+    c.setFont("Helvetica-Bold", font_size)
+    text_y = y + (row_h - font_size) / 2 + 1
+    c.drawString(table_left + 4, text_y, label)
+    c.drawCentredString(total_col_x + col_widths[-1] / 2, text_y, amount)
+
+
+def draw_column_lines(c, table_left, col_widths, top, bottom):
+    x = table_left
+    for w in col_widths:
+        c.line(x, top, x, bottom)
+        x += w
+    c.line(x, top, x, bottom)
+
+
+def draw_page_number(c, page_no):
+    c.setFont("Helvetica", 6)
+    c.drawRightString(PAGE_SIZE[0] - 25, 19, f"Page {page_no}")
+
+
+# ---------------------------------------------------------------------------
+# Transin PDF  (fixed layout – compact, dynamic row heights, DN signature)
+# ---------------------------------------------------------------------------
+
+TRANSIN_HEADERS = [
+    "S.\nno.", "Shipment\nDate", "LR\nNo.", "Destination", "CN\nNumber",
+    "Truck No", "Invoice No", "Pkgs", "Weight\n(kgs)",
+    "Freight\nAmt (Rs.)", "To Point\nCharges\n(Rs.)", "Unloading\nCharge\n(Rs.)",
+    "Source\nDetention\n(Rs.)", "Destination\nDetention\n(Rs.)", "Total\nAmount\n(Rs.)"
+]
+
+TRANSIN_COL_WIDTHS = [22, 48, 33, 52, 48, 48, 82, 28, 42, 48, 48, 48, 48, 52, 52]
+
+
+def _transin_static_top(c, company_code):
+    """Border, header, customer box, invoice box frame and table header grid."""
+    company = COMPANIES[company_code]
+    width, height = PAGE_SIZE
+
+    margin = 15
+    c.rect(margin, margin, width - 2 * margin, height - 2 * margin, stroke=1, fill=0)
+
+    # ── Header ──────────────────────────────────────────────────────────────
+    c.setFont("Helvetica-Bold", 14)
+    c.drawCentredString(width / 2, height - 36, company["name"])
+
+    c.setFont("Helvetica", 7.5)
+    c.drawCentredString(width / 2, height - 50, company["address_line1"])
+    c.drawCentredString(width / 2, height - 60, company["address_line2"])
+
+    c.setFont("Helvetica-Bold", 11)
+    c.drawCentredString(width / 2, height - 76, "INVOICE")
+
+    c.setFont("Helvetica", 6.5)
+    c.drawCentredString(width / 2, height - 87, "@ This is system generated invoice")
+
+    # ── Left box – Customer ─────────────────────────────────────────────────
+    box_top = height - 100
+    box_h = 72
+
+    c.rect(30, box_top - box_h, 252, box_h, stroke=1, fill=0)
+
+    c.setFont("Helvetica-Bold", 8)
+    c.drawString(38, box_top - 14, "To,")
+
+    c.setFont("Helvetica", 7)
+    c.drawString(38, box_top - 26, company["customer"]["name"])
+    c.drawString(38, box_top - 36, company["customer"]["address_line1"])
+    c.drawString(38, box_top - 46, company["customer"]["address_line2"])
+    c.drawString(38, box_top - 58, f"GSTIN: {company['customer']['gstin']}")
+
+    # ── Right box – Invoice details (frame only, values are per bill) ──────
+    c.rect(width - 268, box_top - box_h, 248, box_h, stroke=1, fill=0)
+
+    # ── Table header ────────────────────────────────────────────────────────
+    table_top = box_top - box_h - 20
+    table_left = 30
+    col_widths = TRANSIN_COL_WIDTHS
+    total_col_width = sum(col_widths)
+
+    header_h = 23
+    c.setFillColor(colors.lightgrey)
+    c.rect(table_left, table_top - header_h, total_col_width, header_h, stroke=1, fill=1)
+    c.setFillColor(colors.black)
+    c.setFont("Helvetica-Bold", 5.5)
+
+    x = table_left
+    for i, header in enumerate(TRANSIN_HEADERS):
+        lines = header.split('\n')
+        num_lines = len(lines)
+        y_start = table_top - (header_h - num_lines * 6.5) / 2 - 4.5
+        for j, line in enumerate(lines):
+            c.drawCentredString(x + col_widths[i] / 2, y_start - j * 6.5, line)
+        x += col_widths[i]
+
+    # Header vertical lines
+    x = table_left
+    for wv in col_widths:
+        c.line(x, table_top, x, table_top - header_h)
+        x += wv
+    c.line(x, table_top, x, table_top - header_h)
+
+
+def _transin_static_bottom(c, company_code):
+    """Notes, bank table, signature and footer, relative to the total row's bottom at y=0."""
+    company = COMPANIES[company_code]
+    width, height = PAGE_SIZE
+    y = 0
+
+    # ── Bottom section (per reference layout) ──────────────────────────────
+    # Note line 1 – discrepancy warning
+    note_y = y - 9
+    c.setFont("Helvetica", 6)
+    c.drawString(30, note_y,
+                 'Any changes or discrepancies should be highlighted within 5 working days '
+                 'else it would be considered final. Please send all remittance details to '
+                 '"receivables@onmove.in".')
+
+    # Note line 2 – GST disclaimer
+    note_y -= 9
+    c.setFont("Helvetica", 6)
+    c.drawString(30, note_y, company.get("gst_note", ""))
+
+    # ── Bank-details table (left) + Signature (right) ───────────────────────
+    note_y -= 14                          # gap before table / sig zone
+
+    bank_table_top   = note_y
+    bank_row_h       = 14
+    bank_col1_w      = 130                # label column width
+    bank_col2_w      = 120                # value column width
+    bank_table_left  = 30
+
+    bank_rows = [
+        ("Our PAN No.",          company["bank"]["pan"]),
+        ("Transin GSTIN",        company["bank"]["gstin"]),
+        ("SAC code",             company["bank"]["sac_code"]),
+        ("Transin State Code",   company["bank"]["state_code"]),
+    ]
+
+    for i, (label, value) in enumerate(bank_rows):
+        row_y = bank_table_top - (i * bank_row_h)
         # Two bordered cells per row
         c.rect(bank_table_left,                     row_y - bank_row_h, bank_col1_w, bank_row_h, stroke=1, fill=0)
         c.rect(bank_table_left + bank_col1_w,       row_y - bank_row_h, bank_col2_w, bank_row_h, stroke=1, fill=0)
@@ -663,7 +3387,7 @@ def generate_transin_pdf(df, company_code):
     bank_table_bottom = bank_table_top - (len(bank_rows) * bank_row_h)
 
     # ── Signature block (right side, no DN) ─────────────────────────────────
-    sig = company[" "]
+    sig = company["digital_signature"]
     sig_zone_left   = bank_table_left + bank_col1_w + bank_col2_w + 20   # ~300
     sig_zone_right  = width - 35                                          # ~807
     sig_zone_center = (sig_zone_left + sig_zone_right) / 2
@@ -688,42 +3412,148 @@ def generate_transin_pdf(df, company_code):
     footer_y -= 8
     c.drawString(30, footer_y, "Tax Details - 5% IGST or (2.5% SGST+2.5% CGST) as applicable")
 
+
+def generate_transin_pdf(df, company_code, out=None):
+    if out is None:
+        out = os.path.join(OUTPUT_FOLDER, pdf_filename(df, company_code))
+
+    c = canvas.Canvas(out, pagesize=PAGE_SIZE)
+    draw_transin_bill(c, df, company_code)
     c.save()
-    return pdf_path
+    return out
+
+
+def draw_transin_bill(c, df, company_code):
+    """Draw every page of one Transin bill on c, leaving its last page open."""
+    width, height = PAGE_SIZE
+
+    # ── Right box – Invoice details ─────────────────────────────────────────
+    box_top = height - 100
+    box_h = 72
+
+    def start_page():
+        stamp_static(c, company_code, "top")
+
+        c.setFont("Helvetica-Bold", 8)
+        c.drawString(width - 260, box_top - 14, f"Freight Bill No: {df.iloc[0]['FreightBillNo']}")
+
+        c.setFont("Helvetica", 7)
+        c.drawString(width - 260, box_top - 28, f"Invoice Date: {df['InvoiceDateText'].iat[0]}")
+        c.drawString(width - 260, box_top - 40, f"Due Date: {df['DueDateText'].iat[0]}")
+
+
+        # From location
+        c.setFont("Helvetica", 6.5)
+        c.drawString(30, box_top - box_h - 9, f"From location: {df.iloc[0]['FromLocation']}")
+
+    start_page()
+
+    # ── Table ───────────────────────────────────────────────────────────────
+    table_top = box_top - box_h - 20
+    table_left = 30
+    header_h = 23
+
+    col_widths = TRANSIN_COL_WIDTHS
+    total_col_width = sum(col_widths)
+
+    # ── Data rows (dynamic height, font 7pt) ───────────────────────────────
+    DATA_FONT = 7
+    DATA_LINE_HEIGHT = 8
+    total_row_h = 15
+    footer_h = 110                        # notes, bank table and footer under the total row
+
+    # Columns that may wrap: LR No (2) and Invoice No (6)
+    wrap_columns = {2, 6}
+
+    def measured(values):
+        # InvoiceNo already has Excel newlines normalised to '/'
+        inv_lines = len(wrap_text_lines(c, values[6], col_widths[6] - 4, "Helvetica", DATA_FONT))
+        lr_lines = len(wrap_text_lines(c, values[2], col_widths[2] - 4, "Helvetica", DATA_FONT))
+        max_lines = max(inv_lines, lr_lines, 1)
+        return max(20, max_lines * DATA_LINE_HEIGHT + 6)   # dynamic: expands for multi-line cells
+
+    rows = ((measured(values), (values, amount)) for values, amount in zip(df["Cells"], df["RowTotal"]))
+    data_top = table_top - header_h
+    lines_top = data_top
+    subtotal = 0.0
+    page_no = 1
+
+    for event in layout_rows(rows, data_top, PAGE_BOTTOM, total_row_h, total_row_h + footer_h):
+        if event[0] == "row":
+            _, (values, amount), y, row_height = event
+            subtotal += amount
+
+            x = table_left
+            for i, val in enumerate(values):
+                if i in wrap_columns:
+                    draw_wrapped_text(c, val, x + col_widths[i] / 2, y + row_height / 2,
+                                      col_widths[i] - 4, "Helvetica", DATA_FONT, DATA_LINE_HEIGHT)
+                else:
+                    c.setFont("Helvetica", DATA_FONT)
+                    c.drawCentredString(x + col_widths[i] / 2, y + row_height / 2, val)
+                x += col_widths[i]
+
+            # Horizontal separator
+            c.line(table_left, y, table_left + total_col_width, y)
+        elif event[0] == "break":
+            y = event[1]
+            draw_column_lines(c, table_left, col_widths, lines_top, y)
+            draw_carry_row(c, "Carried forward (Rs.)", f"{subtotal:.1f}", y - total_row_h,
+                           total_row_h, table_left, col_widths, 6.5)
+            draw_page_number(c, page_no)
+            c.showPage()
+            page_no += 1
+            start_page()
+            lines_top = data_top - total_row_h
+            draw_carry_row(c, "Brought forward (Rs.)", f"{subtotal:.1f}", lines_top,
+                           total_row_h, table_left, col_widths, 6.5)
+        else:
+            y = event[1]
+
+    # Vertical lines for data area
+    draw_column_lines(c, table_left, col_widths, lines_top, y)
+    if page_no > 1:
+        draw_page_number(c, page_no)
+
+    # ── Total row ───────────────────────────────────────────────────────────
+    y -= total_row_h
+    c.rect(table_left, y, total_col_width, total_row_h, stroke=1, fill=0)
+
+    c.setFont("Helvetica-Bold", 6.5)
+    c.drawString(table_left + 4, y + 4.5, f"Total in words (Rs.) : {df['TotalWords'].iat[0]} Only")
+
+    c.setFont("Helvetica-Bold", 7.5)
+    total_col_x = table_left + sum(col_widths[:-1])
+    c.drawCentredString(total_col_x + col_widths[-1] / 2, y + 4.5, df["BillTotalText"].iat[0])
+    c.line(total_col_x, y, total_col_x, y + total_row_h)
+
+    # ── Notes, bank table, signature, footer ────────────────────────────────
+    stamp_static(c, company_code, "bottom", dy=y)
 
 
 # ---------------------------------------------------------------------------
 # Basic PDF  (STC – unchanged logic)
 # ---------------------------------------------------------------------------
 
-def generate_basic_pdf(df, company_code):
-    company = COMPANIES[company_code]
+BASIC_HEADERS = [
+    "S.\nno.", "Shipment\nDate", "LR\nNo.", "Destination", "CN\nNumber",
+    "Truck No", "Invoice No", "Pkgs", "Weight\n(Kgs)", "Date of\nArrival",
+    "Date of\nDelivery", "Truck\nType", "Freight\nAmt (Rs.)", "To Point\nCharges(Rs.)",
+    "Unloading\nCharge (Rs.)", "Source\nDetention\n(Rs.)", "Destination\nDetention\n(Rs.)",
+    "Total\nAmount (Rs.)"
+]
+
+BASIC_COL_WIDTHS = [22, 45, 27, 48, 30, 44, 70, 26, 38, 45, 45, 45, 48, 48, 48, 48, 50, 55]
 
-    bill_no = str(df.iloc[0]["FreightBillNo"]).replace("/", "_")
-    pdf_path = f"{OUTPUT_FOLDER}/{company_code}_{bill_no}.pdf"
 
-    c = canvas.Canvas(pdf_path, pagesize=landscape(A4))
-    width, height = landscape(A4)
+def _basic_static_top(c, company_code):
+    """Border, header, customer box, invoice box frame and table header grid."""
+    company = COMPANIES[company_code]
+    width, height = PAGE_SIZE
 
     margin = 15
     c.rect(margin, margin, width - 2 * margin, height - 2 * margin, stroke=1, fill=0)
 
-    # Logo
-    try:
-        if os.path.exists(company["logo"]):
-            try:
-                img = Image.open(company["logo"])
-                img.verify()
-                c.drawImage(company["logo"], 55, height - 140, width=100, height=80, preserveAspectRatio=True)
-            except:
-                c.setFont("Helvetica-Bold", 10)
-                c.drawString(55, height - 80, "[LOGO]")
-        else:
-            c.setFont("Helvetica-Bold", 10)
-            c.drawString(55, height - 80, "[LOGO]")
-    except:
-        pass
-
     # Header
     c.setFont("Helvetica-Bold", 16)
     c.drawCentredString(width / 2, height - 70, company["name"])
@@ -748,35 +3578,15 @@ def generate_basic_pdf(df, company_code):
     c.drawString(40, box_top - 65, company["customer"]["address_line2"])
     c.drawString(40, box_top - 85, f"GSTIN: {company['customer']['gstin']}")
 
-    # Right Box
+    # Right Box (frame only, values are per bill)
     c.rect(width - 290, box_top - 110, 260, 110, stroke=1, fill=0)
 
-    c.setFont("Helvetica-Bold", 10)
-    c.drawString(width - 280, box_top - 25, f"Freight Bill No: {df.iloc[0]['FreightBillNo']}")
-
-    c.setFont("Helvetica", 9)
-    c.drawString(width - 280, box_top - 45, f"Invoice Date:      {df.iloc[0]['InvoiceDate'].strftime('%d %b %Y')}")
-    c.drawString(width - 280, box_top - 65, f"Due Date:          {df.iloc[0]['DueDate'].strftime('%d-%m-%y')}")
-
-    c.setFont("Helvetica", 9)
-    c.drawString(30, box_top - 125, f"From location: {df.iloc[0]['FromLocation']}")
-
-    # Table
+    # Table header
     table_top = box_top - 155
     table_left = 30
-
-    headers = [
-        "S.\nno.", "Shipment\nDate", "LR\nNo.", "Destination", "CN\nNumber",
-        "Truck No", "Invoice No", "Pkgs", "Weight\n(Kgs)", "Date of\nArrival",
-        "Date of\nDelivery", "Truck\nType", "Freight\nAmt (Rs.)", "To Point\nCharges(Rs.)",
-        "Unloading\nCharge (Rs.)", "Source\nDetention\n(Rs.)", "Destination\nDetention\n(Rs.)",
-        "Total\nAmount (Rs.)"
-    ]
-
-    col_widths = [22, 45, 27, 48, 30, 44, 70, 26, 38, 45, 45, 45, 48, 48, 48, 48, 50, 55]
+    col_widths = BASIC_COL_WIDTHS
     total_col_width = sum(col_widths)
 
-    # Header
     c.setFillColor(colors.lightgrey)
     c.rect(table_left, table_top - 30, total_col_width, 30, stroke=1, fill=1)
 
@@ -784,7 +3594,7 @@ def generate_basic_pdf(df, company_code):
     c.setFont("Helvetica-Bold", 7)
 
     x = table_left
-    for i, header in enumerate(headers):
+    for i, header in enumerate(BASIC_HEADERS):
         lines = header.split('\n')
         y_offset = table_top - 9
         for line in lines:
@@ -798,86 +3608,12 @@ def generate_basic_pdf(df, company_code):
         x += width_val
     c.line(x, table_top, x, table_top - 30)
 
-    # Data
-    c.setFont("Helvetica", 7)
-    y = table_top - 30
-    total_amount = 0
-
-    for idx, row in df.iterrows():
-        row_height = 35
-        y -= row_height
-
-        row_total = (
-            float(row["FreightAmt"]) +
-            float(row["ToPointCharges"]) +
-            float(row["UnloadingCharge"]) +
-            float(row["SourceDetention"]) +
-            float(row["DestinationDetention"])
-        )
-        total_amount += row_total
-
-        values = [
-            str(idx + 1),
-            row["ShipmentDate"].strftime("%d %b %Y"),
-            str(row["LRNo"]),
-            str(row["Destination"]),
-            str(row["CNNumber"]),
-            str(row["TruckNo"]),
-            str(row["InvoiceNo"]),
-            str(int(row["Pkgs"])),
-            str(int(row["WeightKgs"])),
-            row["DateArrival"].strftime("%d %b %Y"),
-            row["DateDelivery"].strftime("%d %b %Y"),
-            str(row["TruckType"]),
-            f"{float(row['FreightAmt']):.2f}",
-            f"{float(row['ToPointCharges']):.2f}",
-            f"{float(row['UnloadingCharge']):.2f}",
-            f"{float(row['SourceDetention']):.2f}",
-            f"{float(row['DestinationDetention']):.2f}",
-            f"{row_total:.2f}"
-        ]
-
-        wrap_columns = {6, 11}
 
-        x = table_left
-        for i, val in enumerate(values):
-            if i in wrap_columns:
-                draw_wrapped_text(c, val, x + col_widths[i] / 2, y + row_height / 2,
-                                  col_widths[i] - 6, "Helvetica", 6, 7)
-            else:
-                c.drawCentredString(x + col_widths[i] / 2, y + row_height / 2, val)
-            x += col_widths[i]
-
-        c.line(table_left, y, table_left + total_col_width, y)
-
-    x = table_left
-    for width_val in col_widths:
-        c.line(x, table_top - 30, x, y)
-        x += width_val
-    c.line(x, table_top - 30, x, y)
-
-    # Total Row
-    total_row_height = 25
-    y -= total_row_height
-
-    c.rect(table_left, y, total_col_width, total_row_height, stroke=1, fill=0)
-
-    c.setFont("Helvetica-Bold", 8)
-    rupees = int(total_amount)
-    paise = int((total_amount - rupees) * 100)
-
-    if paise > 0:
-        total_words = f"{num2words(rupees, lang='en_IN').title()} Rupees and {num2words(paise, lang='en_IN').title()} Paise"
-    else:
-        total_words = f"{num2words(rupees, lang='en_IN').title()} Rupees"
-
-    c.drawString(table_left + 5, y + 10, f"Total in words (Rs.) :  {total_words} Only")
-
-    c.setFont("Helvetica-Bold", 9)
-    total_col_x = table_left + sum(col_widths[:-1])
-    c.drawCentredString(total_col_x + col_widths[-1] / 2, y + 10, f"{total_amount:.2f}")
-
-    c.line(total_col_x, y, total_col_x, y + total_row_height)
+def _basic_static_bottom(c, company_code):
+    """Note, bank details and signature, relative to the total row's bottom at y=0."""
+    company = COMPANIES[company_code]
+    width, height = PAGE_SIZE
+    y = 0
 
     # Note
     c.setFont("Helvetica", 7)
@@ -920,8 +3656,183 @@ def generate_basic_pdf(df, company_code):
     c.drawRightString(width - 35, sig_y - 50, "(Authorized Signatory)")
     c.line(width - 180, sig_y - 52, width - 35, sig_y - 52)
 
+
+def generate_basic_pdf(df, company_code, out=None):
+    if out is None:
+        out = os.path.join(OUTPUT_FOLDER, pdf_filename(df, company_code))
+
+    c = canvas.Canvas(out, pagesize=PAGE_SIZE)
+    draw_basic_bill(c, df, company_code)
     c.save()
-    return pdf_path
+    return out
+
+
+def draw_basic_bill(c, df, company_code):
+    """Draw every page of one STC-style bill on c, leaving its last page open."""
+    company = COMPANIES[company_code]
+    width, height = PAGE_SIZE
+
+    # Right Box
+    box_top = height - 160
+
+    def start_page():
+        stamp_static(c, company_code, "top")
+
+        # Logo
+        logo = get_logo(company["logo"], 100, 80)
+        if logo is not None:
+            c.drawImage(logo, 55, height - 140, width=100, height=80, preserveAspectRatio=True)
+        else:
+            c.setFont("Helvetica-Bold", 10)
+            c.drawString(55, height - 80, "[LOGO]")
+
+        c.setFont("Helvetica-Bold", 10)
+        c.drawString(width - 280, box_top - 25, f"Freight Bill No: {df.iloc[0]['FreightBillNo']}")
+
+        c.setFont("Helvetica", 9)
+        c.drawString(width - 280, box_top - 45, f"Invoice Date:      {df['InvoiceDateText'].iat[0]}")
+        c.drawString(width - 280, box_top - 65, f"Due Date:          {df['DueDateText'].iat[0]}")
+
+        c.setFont("Helvetica", 9)
+        c.drawString(30, box_top - 125, f"From location: {df.iloc[0]['FromLocation']}")
+
+    start_page()
+
+    # Table
+    table_top = box_top - 155
+    table_left = 30
+
+    col_widths = BASIC_COL_WIDTHS
+    total_col_width = sum(col_widths)
+
+    # Data
+    row_height = 35
+    total_row_height = 25
+    footer_h = 120                        # note, bank details and signature under the total row
+    wrap_columns = {6, 11}
+
+    rows = ((row_height, item) for item in zip(df["Cells"], df["RowTotal"]))
+    data_top = table_top - 30
+    lines_top = data_top
+    subtotal = 0.0
+    page_no = 1
+
+    c.setFont("Helvetica", 7)
+    for event in layout_rows(rows, data_top, PAGE_BOTTOM, total_row_height, total_row_height + footer_h):
+        if event[0] == "row":
+            _, (values, amount), y, _ = event
+            subtotal += amount
+
+            x = table_left
+            for i, val in enumerate(values):
+                if i in wrap_columns:
+                    draw_wrapped_text(c, val, x + col_widths[i] / 2, y + row_height / 2,
+                                      col_widths[i] - 6, "Helvetica", 6, 7)
+                else:
+                    c.drawCentredString(x + col_widths[i] / 2, y + row_height / 2, val)
+                x += col_widths[i]
+
+            c.line(table_left, y, table_left + total_col_width, y)
+        elif event[0] == "break":
+            y = event[1]
+            draw_column_lines(c, table_left, col_widths, lines_top, y)
+            draw_carry_row(c, "Carried forward (Rs.)", f"{subtotal:.2f}", y - total_row_height,
+                           total_row_height, table_left, col_widths, 8)
+            draw_page_number(c, page_no)
+            c.showPage()
+            page_no += 1
+            start_page()
+            lines_top = data_top - total_row_height
+            draw_carry_row(c, "Brought forward (Rs.)", f"{subtotal:.2f}", lines_top,
+                           total_row_height, table_left, col_widths, 8)
+            c.setFont("Helvetica", 7)
+        else:
+            y = event[1]
+
+    draw_column_lines(c, table_left, col_widths, lines_top, y)
+    if page_no > 1:
+        draw_page_number(c, page_no)
+
+    # Total Row
+    y -= total_row_height
+
+    c.rect(table_left, y, total_col_width, total_row_height, stroke=1, fill=0)
+
+    c.setFont("Helvetica-Bold", 8)
+    c.drawString(table_left + 5, y + 10, f"Total in words (Rs.) :  {df['TotalWords'].iat[0]} Only")
+
+    c.setFont("Helvetica-Bold", 9)
+    total_col_x = table_left + sum(col_widths[:-1])
+    c.drawCentredString(total_col_x + col_widths[-1] / 2, y + 10, df["BillTotalText"].iat[0])
+
+    c.line(total_col_x, y, total_col_x, y + total_row_height)
+
+    # Note, bank details, signature
+    stamp_static(c, company_code, "bottom", dy=y)
+
+
+_STATIC_DRAWERS = {
+    ("transin", "top"): _transin_static_top,
+    ("transin", "bottom"): _transin_static_bottom,
+    ("basic", "top"): _basic_static_top,
+    ("basic", "bottom"): _basic_static_bottom,
+}
+
+
+# ---------------------------------------------------------------------------
+# Start-up – warm-up and start-up timing
+# ---------------------------------------------------------------------------
+
+_HEAVY_MODULES = ("pandas", "openpyxl", "reportlab.pdfgen.canvas", "PIL.Image", "num2words")
+_startup = {"import_seconds": None, "warm_seconds": None, "first_request": None}
+_first_request_lock = threading.Lock()
+
+
+def warm_up():
+    """Load and exercise everything a first PDF would otherwise pay for.
+
+    Each company's template is built, read back through both upload parsers
+    and rendered, which imports pandas, openpyxl, ReportLab, Pillow and
+    num2words and fills the font metric, logo, text-wrap and page layer
+    caches.  Metrics recorded on the way are dropped, so they are not
+    mistaken for real requests.
+    """
+    start = time.perf_counter()
+    with warnings.catch_warnings():
+        # The sample dates are ISO, which the day-first parser warns about
+        warnings.simplefilter("ignore", UserWarning)
+        for company_code in COMPANIES:
+            try:
+                _, data, _ = excel_template(company_code)
+                for _ in iter_sheet_chunks(io.BytesIO(data)):
+                    pass
+                render_pdf(load_bill_sheet(io.BytesIO(data)), company_code)
+            except Exception as e:
+                log_event("warm_up", level=logging.WARNING, company=company_code, error=str(e))
+    metrics.clear()
+    _startup["warm_seconds"] = time.perf_counter() - start
+
+
+def report_startup():
+    """Publish the start-up timings as gauges and log them."""
+    for phase in ("import", "warm"):
+        seconds = _startup[f"{phase}_seconds"]
+        if seconds is not None:
+            metrics.set("portal_startup_seconds", seconds, phase=phase)
+    log_event("startup", pid=os.getpid(), warm=WARM_START,
+              import_seconds=round(_startup["import_seconds"], 4),
+              warm_seconds=_startup["warm_seconds"] and round(_startup["warm_seconds"], 4),
+              loaded=[name for name in _HEAVY_MODULES if name in sys.modules])
+
+
+init_db()
+migrate_history_file()
+_startup["import_seconds"] = time.perf_counter() - _IMPORT_STARTED
+# PDF pool processes import the app as well; only the main process (and the
+# pool's forkserver, which has no parent process) warms up.
+if WARM_START and multiprocessing.parent_process() is None:
+    warm_up()
+report_startup()
 
 
 # ---------------------------------------------------------------------------
@@ -0,0 +1,317 @@
+"""Benchmarks for the billing portal hot paths.
+
+Synthetic STC and Transin sheets are generated at each size and every stage
+is timed on its own: reading the workbook, parsing its date columns,
+rendering the PDFs, zipping them and the full POST / through Flask's test
+client.  Start-up is measured in fresh processes, cold and with WARM_START:
+importing the app, the first /api/companies and the first two POST /.
+Results are printed and written as JSON for comparing releases.
+
+Run:  python benchmark.py [--sizes 10 1000 10000 100000] [--out bench.json]
+                          [--repeat 3] [--workers N] [--skip-post] [--skip-startup]
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Keep the portal's database out of the working tree while benchmarking.
+_WORKDIR = tempfile.mkdtemp(prefix="portal-bench-")
+os.environ.setdefault("PORTAL_DB", os.path.join(_WORKDIR, "portal.db"))
+
+import pandas as pd
+
+import app
+from app import (COMPANIES, generate_multiple_pdfs, iter_bill_groups, iter_bill_pdfs, load_bill_sheet,
+                 parse_date_column, prepare_bills, safe_parse_date, stream_zip)
+
+DEFAULT_SIZES = [10, 1000, 10000, 100000]
+
+DESTINATIONS = ["Delhi", "Kolkata", "Ahmedabad", "Mumbai", "Chennai", "Lucknow", "Jaipur", "Pune"]
+TRUCK_TYPES = ["Open Body", "19FT06 TYRE", "28FT 14 TYRE", "32FT MXL"]
+
+# Rows per freight bill and how often each occurs – most bills cover a few
+# trips, some a month of them.
+BILL_SIZES = [1, 2, 3, 5, 8, 15, 30]
+BILL_SIZE_WEIGHTS = [30, 20, 15, 15, 10, 7, 3]
+
+
+def make_date_column(rows, seed=7):
+    """A date column mixing every format clerks put in the sheets."""
+    rnd = random.Random(seed)
+    base = datetime(2025, 4, 1)
+    values = []
+    for _ in range(rows):
+        d = base + timedelta(days=rnd.randint(0, 365))
+        kind = rnd.random()
+        if kind < 0.5:
+            values.append(d)                                   # real Excel date cell
+        elif kind < 0.7:
+            values.append(d.strftime("%d%m%Y"))                # ddmmyyyy, no separator
+        elif kind < 0.75:
+            values.append(d.strftime("%Y%m%d"))                # yyyymmdd, no separator
+        elif kind < 0.95:
+            values.append(d.strftime(rnd.choice(["%d-%m-%Y", "%d/%m/%Y", "%d.%m.%Y"])))
+        elif kind < 0.98:
+            values.append(None)
+        else:
+            values.append(rnd.choice(["", "N/A", "31022025"]))
+    return pd.Series(values, dtype=object)
+
+
+def make_sheet(company_code, rows, seed=11):
+    """A bill sheet of `rows` rows for one company, grouped into bills like real uploads."""
+    rnd = random.Random(seed)
+    transin = COMPANIES[company_code].get("type") == "transin"
+    base = datetime(2025, 4, 1)
+    records = []
+    bill_seq = 0
+    while len(records) < rows:
+        bill_seq += 1
+        bill_no = f"DBLT1-2526-{bill_seq:05d}" if transin else f"2025/26/{bill_seq:05d}"
+        invoice = base + timedelta(days=rnd.randint(0, 365))
+        size = min(rnd.choices(BILL_SIZES, BILL_SIZE_WEIGHTS)[0], rows - len(records))
+        for _ in range(size):
+            shipped = invoice - timedelta(days=rnd.randint(1, 30))
+            record = {
+                'FreightBillNo': bill_no,
+                'InvoiceDate': invoice.strftime("%d-%m-%Y"),
+                'DueDate': (invoice + timedelta(days=30)).strftime("%d-%m-%Y"),
+                'FromLocation': "Kichha" if transin else "Roorkee",
+                'ShipmentDate': shipped.strftime(rnd.choice(["%d-%m-%Y", "%d%m%Y"])),
+                'LRNo': rnd.randint(100, 99999),
+                'Destination': rnd.choice(DESTINATIONS),
+                'CNNumber': f"DT{rnd.randint(10 ** 9, 10 ** 10 - 1)}",
+                'TruckNo': f"UK{rnd.randint(1, 20):02d}CB{rnd.randint(1000, 9999)}",
+                # Some trips carry several invoices, one per line in the cell
+                'InvoiceNo': "\n".join(f"F{rnd.randint(10 ** 10, 10 ** 11 - 1)}"
+                                       for _ in range(rnd.choice([1, 1, 1, 2, 3]))),
+                'Pkgs': rnd.randint(10, 4000),
+                'WeightKgs': rnd.randint(500, 28000),
+            }
+            if not transin:
+                record['DateArrival'] = (shipped + timedelta(days=2)).strftime("%d-%m-%Y")
+                record['DateDelivery'] = (shipped + timedelta(days=3)).strftime("%d-%m-%Y")
+                record['TruckType'] = rnd.choice(TRUCK_TYPES)
+            record.update({
+                'FreightAmt': rnd.randint(5000, 120000),
+                'ToPointCharges': rnd.choice([0, 0, 500, 1200]),
+                'UnloadingCharge': rnd.choice([0, 300, 400]),
+                'SourceDetention': rnd.choice([0, 0, 0, 1500]),
+                'DestinationDetention': rnd.choice([0, 0, 0, 2000]),
+            })
+            records.append(record)
+    return pd.DataFrame(records)
+
+
+def sheet_bytes(df):
+    buf = io.BytesIO()
+    df.to_excel(buf, index=False)
+    return buf.getvalue()
+
+
+def timed(fn, *args, repeat=3, setup=None):
+    """Best wall time of `repeat` calls and the last result; setup() runs untimed before each."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def fresh_output():
+    """Point the portal at an empty output folder so no bill is reused between runs."""
+    folder = os.path.join(_WORKDIR, "output")
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    app.OUTPUT_FOLDER = folder
+    app.UPLOAD_FOLDER = _WORKDIR
+
+
+def bench_parse_dates(rows):
+    series = make_date_column(rows)
+    legacy_s, legacy = timed(lambda s: s.apply(safe_parse_date), series)
+    fast_s, fast = timed(parse_date_column, series)
+    pd.testing.assert_series_equal(legacy, fast)
+    return {"rows": rows, "apply_s": legacy_s, "vectorised_s": fast_s, "speedup": legacy_s / fast_s}
+
+
+def bench_company(company_code, rows, repeat=3, workers=None, post=True):
+    """Time every stage for one synthetic sheet; returns a result dict."""
+    data = sheet_bytes(make_sheet(company_code, rows))
+    path = os.path.join(_WORKDIR, f"{company_code}_{rows}.xlsx")
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    stages = {}
+    stages["read_excel_s"], raw = timed(pd.read_excel, path, repeat=repeat)
+
+    def parse_dates(df):
+        df = df.copy()
+        for col in app.DATE_COLUMNS:
+            if col in df.columns:
+                df[col] = parse_date_column(df[col])
+        return df
+
+    stages["parse_dates_s"], _ = timed(parse_dates, raw, repeat=repeat)
+    sheet = load_bill_sheet(path)
+    stages["prepare_s"], prepared = timed(prepare_bills, sheet, company_code, repeat=repeat)
+    bills = prepared['FreightBillNo'].nunique()
+
+    stages["render_s"], _ = timed(generate_multiple_pdfs, prepared, company_code, workers,
+                                  repeat=repeat, setup=fresh_output)
+
+    fresh_output()
+    rendered = list(iter_bill_pdfs(iter_bill_groups(prepared), company_code, workers))
+    stages["zip_s"], archive = timed(lambda: b"".join(stream_zip(rendered)), repeat=repeat)
+
+    if post:
+        client = app.app.test_client()
+
+        def post_upload():
+            response = client.post("/", data={"company": company_code,
+                                              "file": (io.BytesIO(data), f"{company_code}_{rows}.xlsx")})
+            body = response.get_data()
+            if response.status_code != 200:
+                raise RuntimeError(f"POST / failed ({response.status_code}): {body[:200]!r}")
+            return body
+
+        stages["post_s"], _ = timed(post_upload, repeat=repeat, setup=fresh_output)
+
+    return {
+        "company": company_code,
+        "rows": rows,
+        "bills": bills,
+        "zip_bytes": len(archive),
+        "stages": stages,
+        "bills_per_s": bills / stages["render_s"] if stages["render_s"] else None,
+    }
+
+
+# Runs in a fresh interpreter: argv is the repo path, company code and sheet file.
+STARTUP_SCRIPT = """
+import io, json, sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import app
+result = {"import_s": time.perf_counter() - start}
+client = app.app.test_client()
+start = time.perf_counter()
+client.get("/api/companies")
+result["companies_s"] = time.perf_counter() - start
+result["heavy_loaded"] = [name for name in app._HEAVY_MODULES if name in sys.modules]
+with open(sys.argv[3], "rb") as f:
+    data = f.read()
+for key in ("first_post_s", "second_post_s"):
+    start = time.perf_counter()
+    response = client.post("/", data={"company": sys.argv[2], "file": (io.BytesIO(data), "sheet.xlsx")})
+    response.get_data()
+    result[key] = time.perf_counter() - start
+print(json.dumps(result))
+"""
+
+
+def bench_startup(company_code, rows=10, repeat=3):
+    """Start-up and first-request latency in fresh processes, cold and warmed."""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    sheet = os.path.join(_WORKDIR, f"startup_{company_code}.xlsx")
+    with open(sheet, 'wb') as f:
+        f.write(sheet_bytes(make_sheet(company_code, rows)))
+
+    results = []
+    for warm in (False, True):
+        best = {}
+        for _ in range(repeat):
+            # Each run gets empty folders and database, with the logos in place
+            cwd = tempfile.mkdtemp(dir=_WORKDIR)
+            os.symlink(os.path.join(repo, "static"), os.path.join(cwd, "static"))
+            env = dict(os.environ, PORTAL_DB=os.path.join(cwd, "portal.db"), WARM_START="1" if warm else "0",
+                       JANITOR_INTERVAL="0", LOG_LEVEL="WARNING")
+            out = subprocess.run([sys.executable, "-W", "ignore", "-c", STARTUP_SCRIPT, repo, company_code, sheet],
+                                 cwd=cwd, env=env, capture_output=True, text=True, check=True).stdout
+            run = json.loads(out.strip().splitlines()[-1])
+            for key, value in run.items():
+                best[key] = value if key not in best or isinstance(value, list) else min(best[key], value)
+        results.append({"company": company_code, "rows": rows, "warm_start": warm, **best})
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "pdf_workers": app.PDF_WORKERS,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="rows per sheet")
+    parser.add_argument("--companies", nargs="+", default=list(COMPANIES), choices=list(COMPANIES))
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage; the best is kept")
+    parser.add_argument("--workers", type=int, default=None, help="PDF workers (default: PDF_WORKERS)")
+    parser.add_argument("--skip-post", action="store_true", help="do not time POST / end to end")
+    parser.add_argument("--skip-startup", action="store_true", help="do not time start-up in fresh processes")
+    parser.add_argument("--out", default="bench_output.json", help="JSON results file")
+    args = parser.parse_args(argv)
+
+    results = {"environment": environment(), "parse_dates": [], "companies": [], "startup": []}
+
+    print(f"{'rows':>8} {'apply (s)':>12} {'vectorised (s)':>15} {'speedup':>8}")
+    for n in args.sizes:
+        r = bench_parse_dates(n)
+        results["parse_dates"].append(r)
+        print(f"{r['rows']:>8} {r['apply_s']:>12.4f} {r['vectorised_s']:>15.4f} {r['speedup']:>7.1f}x")
+
+    columns = ["read_excel_s", "parse_dates_s", "prepare_s", "render_s", "zip_s", "post_s"]
+    print()
+    print(f"{'company':>8} {'rows':>8} {'bills':>7} " + " ".join(f"{c[:-2]:>11}" for c in columns))
+    for company_code in args.companies:
+        for n in args.sizes:
+            r = bench_company(company_code, n, args.repeat, args.workers, post=not args.skip_post)
+            results["companies"].append(r)
+            times = " ".join(f"{r['stages'][c]:>11.4f}" if c in r["stages"] else f"{'-':>11}" for c in columns)
+            print(f"{company_code:>8} {n:>8} {r['bills']:>7} {times}")
+
+    if not args.skip_startup:
+        columns = ["import_s", "companies_s", "first_post_s", "second_post_s"]
+        print()
+        print(f"{'company':>8} {'warm':>5} " + " ".join(f"{c[:-2]:>12}" for c in columns) + "  heavy modules after /api/companies")
+        for company_code in args.companies:
+            for r in bench_startup(company_code, repeat=args.repeat):
+                results["startup"].append(r)
+                times = " ".join(f"{r[c]:>12.4f}" for c in columns)
+                print(f"{company_code:>8} {'yes' if r['warm_start'] else 'no':>5} {times}  {', '.join(r['heavy_loaded']) or '-'}")
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.out}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        shutil.rmtree(_WORKDIR, ignore_errors=True)
@@ -0,0 +1,83 @@
+import io
+import os
+import sys
+import tempfile
+
+# The app opens its database on import; keep it out of the working tree.
+_DB_DIR = tempfile.mkdtemp(prefix="portal-tests-")
+os.environ.setdefault("PORTAL_DB", os.path.join(_DB_DIR, "portal.db"))
+os.environ.setdefault("JANITOR_INTERVAL", "0")
+os.environ.setdefault("METRICS_PUBLISH_INTERVAL", "0")
+os.environ.setdefault("WARM_START", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+import pytest
+
+import app as portal
+
+
+@pytest.fixture(autouse=True)
+def no_background_threads(monkeypatch):
+    """Tests run jobs themselves (run_next_job) instead of on job threads."""
+    monkeypatch.setattr(portal, "_ensure_job_workers", lambda: None)
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """Point the portal's folders and database at an empty temporary tree."""
+    folders = {
+        "UPLOAD_FOLDER": tmp_path / "uploads",
+        "OUTPUT_FOLDER": tmp_path / "output",
+        "JOBS_FOLDER": tmp_path / "output" / "jobs",
+        "PROFILES_FOLDER": tmp_path / "output" / "profiles",
+        "PARSE_CACHE_FOLDER": tmp_path / "uploads" / "parsed",
+    }
+    for name, path in folders.items():
+        path.mkdir(parents=True, exist_ok=True)
+        monkeypatch.setattr(portal, name, str(path))
+    monkeypatch.setattr(portal, "DB_PATH", str(tmp_path / "portal.db"))
+    portal.init_db()
+    return tmp_path
+
+
+def bill_rows(bill_nos, transin=False):
+    """One sheet row per entry of bill_nos, with every column the renderers need."""
+    rows = []
+    for i, bill_no in enumerate(bill_nos):
+        row = {
+            'FreightBillNo': bill_no,
+            'InvoiceDate': "15-01-2025",
+            'DueDate': "15-02-2025",
+            'FromLocation': "Kichha" if transin else "Roorkee",
+            'ShipmentDate': "10-01-2025",
+            'LRNo': 1000 + i,
+            'Destination': "Delhi",
+            'CNNumber': f"CN{i:05d}",
+            'TruckNo': "UK01AB1234",
+            'InvoiceNo': f"INV{i:05d}",
+            'Pkgs': 10,
+            'WeightKgs': 500,
+        }
+        if not transin:
+            row.update({'DateArrival': "12-01-2025", 'DateDelivery': "13-01-2025", 'TruckType': "Open Body"})
+        row.update({'FreightAmt': 5000 + i, 'ToPointCharges': 0, 'UnloadingCharge': 300,
+                    'SourceDetention': 0, 'DestinationDetention': 0})
+        rows.append(row)
+    return rows
+
+
+def sheet_bytes(rows):
+    buf = io.BytesIO()
+    pd.DataFrame(rows).to_excel(buf, index=False)
+    return buf.getvalue()
+
+
+@pytest.fixture
+def write_sheet(tmp_path):
+    """write_sheet(rows) -> path of an .xlsx holding rows."""
+    def write(rows, name="sheet.xlsx"):
+        path = tmp_path / name
+        path.write_bytes(sheet_bytes(rows))
+        return str(path)
+    return write
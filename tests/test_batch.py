@@ -0,0 +1,54 @@
+import io
+import zipfile
+
+import pytest
+from conftest import bill_rows, sheet_bytes
+
+import app as portal
+
+
+def zip_of(members):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buf.getvalue()
+
+
+def post_batch(data, name="batch.zip"):
+    return portal.app.test_client().post(
+        "/api/batch", data={"company": "stc", "persist": "0", "files": [(io.BytesIO(data), name)]})
+
+
+@pytest.fixture
+def small_limits(monkeypatch):
+    monkeypatch.setattr(portal, "BATCH_MAX_WORKBOOK_MB", 1)
+    monkeypatch.setattr(portal, "BATCH_MAX_TOTAL_MB", 2)
+
+
+def test_zip_bomb_member_is_refused_unread(storage, small_limits, monkeypatch):
+    monkeypatch.setattr(zipfile.ZipFile, "read", lambda *a, **k: pytest.fail("member was read"))
+    response = post_batch(zip_of({"bomb.xlsx": b"\0" * (2 * 1024 * 1024)}))
+    assert response.status_code == 413
+    assert "bomb.xlsx" in response.get_json()["error"]
+
+
+def test_batch_total_is_capped(storage, small_limits):
+    members = {f"part{i}.xlsx": b"\0" * (900 * 1024) for i in range(3)}
+    response = post_batch(zip_of(members))
+    assert response.status_code == 413
+    assert "Batch" in response.get_json()["error"]
+
+
+def test_request_size_is_capped(storage, monkeypatch):
+    monkeypatch.setitem(portal.app.config, "MAX_CONTENT_LENGTH", 1024)
+    response = post_batch(b"x" * 4096, "big.xlsx")
+    assert response.status_code == 413
+    assert response.is_json
+
+
+def test_batch_within_limits_is_generated(storage, small_limits):
+    response = post_batch(zip_of({"stc/a.xlsx": sheet_bytes(bill_rows(["FB/1"]))}))
+    assert response.status_code == 200
+    names = zipfile.ZipFile(io.BytesIO(response.get_data())).namelist()
+    assert "manifest.json" in names
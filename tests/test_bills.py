@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+import app as portal
+
+
+@pytest.fixture
+def bill_files(storage):
+    name = portal.bill_pdf_name("FB/1", "stc")
+    for suffix in ("", ".sha256", ".gz", ".0123abcd.tmp"):
+        with open(os.path.join(portal.OUTPUT_FOLDER, name + suffix), 'wb') as f:
+            f.write(b"%PDF-1.4" if suffix == "" else b"x")
+    for other in (".hidden.pdf", "_partial.pdf"):
+        with open(os.path.join(portal.OUTPUT_FOLDER, other), 'wb') as f:
+            f.write(b"%PDF-1.4")
+    return name
+
+
+def test_bill_pdf_is_served(bill_files):
+    response = portal.app.test_client().get(f"/api/bills/{bill_files}")
+    assert response.status_code == 200 and response.get_data() == b"%PDF-1.4"
+
+
+@pytest.mark.parametrize("suffix", [".sha256", ".gz", ".0123abcd.tmp"])
+def test_bill_companions_are_not_served(bill_files, suffix):
+    assert portal.app.test_client().get(f"/api/bills/{bill_files}{suffix}").status_code == 404
+
+
+@pytest.mark.parametrize("name", [".hidden.pdf", "_partial.pdf"])
+def test_hidden_and_private_files_are_not_served(bill_files, name):
+    assert portal.app.test_client().get(f"/api/bills/{name}").status_code == 404
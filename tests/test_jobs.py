@@ -0,0 +1,88 @@
+import io
+import os
+import socket
+import time
+
+from conftest import bill_rows, sheet_bytes
+
+import app as portal
+
+
+def insert_job(job_id, status="queued", heartbeat=None, attempts=0, created="2025-01-01 00:00:00"):
+    with portal.get_db() as conn:
+        conn.execute(
+            "INSERT INTO jobs (id, status, file, company_code, created, heartbeat, attempts) "
+            "VALUES (?, ?, 'a.xlsx', 'stc', ?, ?, ?)",
+            (job_id, status, created, heartbeat, attempts)
+        )
+
+
+def status(job_id):
+    return portal.get_job(job_id, with_bills=False)["status"]
+
+
+def test_claim_takes_oldest_queued_job_once(storage):
+    insert_job("b" * 32, created="2025-01-02 00:00:00")
+    insert_job("a" * 32, created="2025-01-01 00:00:00")
+    first = portal.claim_job()
+    second = portal.claim_job()
+    assert (first["id"], second["id"]) == ("a" * 32, "b" * 32)
+    assert first["owner"].startswith(f"{socket.gethostname()}:{os.getpid()}/") and first["attempts"] == 1
+    assert first["owner"] != second["owner"]
+    assert portal.claim_job() is None
+
+
+def test_running_job_of_a_dead_worker_is_requeued(storage):
+    now = time.time()
+    insert_job("a" * 32, "running", heartbeat=now - portal.JOB_STALE_SECONDS - 1, attempts=1)
+    insert_job("b" * 32, "running", heartbeat=now, attempts=1)
+    insert_job("c" * 32, "running", heartbeat=None, attempts=1)     # written before heartbeats existed
+    assert portal.requeue_stale_jobs(now) == 2
+    assert [status(j * 32) for j in "abc"] == ["queued", "running", "queued"]
+
+
+def test_job_interrupted_too_often_fails(storage):
+    insert_job("a" * 32, "running", heartbeat=0, attempts=portal.JOB_MAX_ATTEMPTS)
+    portal.requeue_stale_jobs()
+    job = portal.get_job("a" * 32, with_bills=False)
+    assert job["status"] == "failed" and "interrupted" in job["error"]
+
+
+def test_submitted_job_runs_to_completion(storage):
+    client = portal.app.test_client()
+    data = sheet_bytes(bill_rows(["FB/1", "FB/1", "FB/2"]))
+    job = client.post("/api/jobs", data={"company": "stc", "file": (io.BytesIO(data), "a.xlsx")}).get_json()
+    assert status(job["job_id"]) == "queued"
+    assert portal.run_next_job()
+    assert not portal.run_next_job()
+    done = portal.get_job(job["job_id"])
+    assert done["status"] == "done", done.get("error")
+    assert done["done_bills"] == 2
+    assert client.get(job["download_url"]).status_code == 200
+
+
+def test_job_of_a_dead_worker_is_finished_by_another(storage):
+    client = portal.app.test_client()
+    data = sheet_bytes(bill_rows(["FB/1", "FB/2"]))
+    job_id = client.post("/api/jobs", data={"company": "stc", "file": (io.BytesIO(data), "a.xlsx")}).get_json()["job_id"]
+    claimed = portal.claim_job()
+    with portal.get_db() as conn:                       # its worker died half way
+        conn.execute("INSERT INTO job_bills (job_id, seq, bill_no, status) VALUES (?, 0, 'FB/1', 'done')", (job_id,))
+        conn.execute("UPDATE jobs SET heartbeat = 0, done_bills = 1 WHERE id = ?", (claimed["id"],))
+
+    assert portal.run_next_job()
+    done = portal.get_job(job_id)
+    assert done["status"] == "done" and done["attempts"] == 2
+    assert done["done_bills"] == 2 and [b["status"] for b in done["bills"]] == ["done", "done"]
+
+
+def test_heartbeat_of_a_lost_claim_is_refused(storage):
+    insert_job("a" * 32)
+    lost = portal.claim_job()
+    with portal.get_db() as conn:                       # stalled long enough to be requeued
+        conn.execute("UPDATE jobs SET heartbeat = 0 WHERE id = ?", (lost["id"],))
+    portal.requeue_stale_jobs()
+    taken = portal.claim_job()
+    assert taken["id"] == lost["id"]
+    assert not portal.touch_job(lost["id"], lost["owner"])
+    assert portal.touch_job(taken["id"], taken["owner"])
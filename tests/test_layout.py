@@ -0,0 +1,80 @@
+import io
+
+import pandas as pd
+import pytest
+from conftest import bill_rows
+from reportlab.pdfgen import canvas
+
+import app as portal
+
+DRAW_BILL = {"stc": portal.draw_basic_bill, "transin": portal.draw_transin_bill}
+
+
+def layout(heights, top=100, bottom=0, carry_h=10, tail_h=10):
+    return list(portal.layout_rows(((h, i) for i, h in enumerate(heights)), top, bottom, carry_h, tail_h))
+
+
+def test_rows_that_fit_stay_on_one_page():
+    assert layout([20, 20, 20]) == [
+        ("row", 0, 80, 20), ("row", 1, 60, 20), ("row", 2, 40, 20), ("end", 40)]
+
+
+def test_page_breaks_keep_room_for_the_carry_row():
+    events = layout([20] * 6)
+    # four rows reach y=20; a fifth would cut into the carry row above bottom
+    assert events[4] == ("break", 20)
+    # the next page starts under the brought-forward row
+    assert events[5] == ("row", 4, 70, 20)
+    assert events[-1] == ("end", 50)
+
+
+def test_total_and_footer_move_to_a_new_page_when_they_do_not_fit():
+    events = layout([20] * 4, tail_h=30)
+    assert events[-2:] == [("break", 20), ("end", 90)]
+
+
+def test_a_row_taller_than_a_page_is_placed_anyway():
+    events = layout([500, 20])
+    assert events[0] == ("row", 0, -400, 500)
+    assert events[1] == ("break", -400)
+    assert events[2] == ("row", 1, 70, 20)
+
+
+def test_rows_are_pulled_lazily():
+    pulled = []
+
+    def rows():
+        for i in range(10):
+            pulled.append(i)
+            yield 20, i
+
+    events = portal.layout_rows(rows(), 100, 0, 10, 10)
+    next(events)
+    assert pulled == [0]
+
+
+def draw(company_code, row_count):
+    rows = bill_rows(["FB/1"] * row_count, transin=company_code == "transin")
+    df = portal.prepare_bills(portal.normalise_dates(pd.DataFrame(rows)), company_code)
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=portal.PAGE_SIZE, pageCompression=0)
+    DRAW_BILL[company_code](c, df, company_code)
+    pages = c.getPageNumber()
+    c.save()
+    return pages, buf.getvalue()
+
+
+@pytest.mark.parametrize("company_code", ["stc", "transin"])
+def test_short_bill_has_one_page_without_carry_rows(company_code):
+    pages, pdf = draw(company_code, 1)
+    assert pages == 1
+    assert b"Carried forward" not in pdf and b"Page 1" not in pdf
+
+
+@pytest.mark.parametrize("company_code", ["stc", "transin"])
+def test_long_bill_carries_subtotals_across_numbered_pages(company_code):
+    pages, pdf = draw(company_code, 120)
+    assert pages > 1
+    assert pdf.count(b"Carried forward") == pages - 1
+    assert pdf.count(b"Brought forward") == pages - 1
+    assert b"Page %d" % pages in pdf
@@ -0,0 +1,47 @@
+import json
+import time
+
+import app as portal
+
+
+def store_worker(worker, snapshot, updated):
+    with portal.get_db() as conn:
+        conn.execute("INSERT INTO metrics (worker, updated, data) VALUES (?, ?, ?)",
+                     (worker, updated, json.dumps(snapshot)))
+
+
+def other_worker(rendered, seconds):
+    other = portal.Metrics()
+    other.inc("portal_bills_total", rendered, company="stc", result="rendered")
+    other.observe("portal_request_seconds", seconds, endpoint="generate", company="stc")
+    other.set("portal_first_request_seconds", 0.5, endpoint="index")
+    return other.snapshot()
+
+
+def test_metrics_add_up_every_worker(storage, monkeypatch):
+    monkeypatch.setattr(portal, "metrics", portal.Metrics())
+    portal.metrics.inc("portal_bills_total", 2, company="stc", result="rendered")
+    portal.metrics.observe("portal_request_seconds", 0.2, endpoint="generate", company="stc")
+    store_worker("other:1", other_worker(5, 3), time.time())
+
+    body = portal.app.test_client().get("/metrics").get_data(as_text=True)
+
+    assert 'portal_bills_total{company="stc",result="rendered"} 7' in body
+    assert 'portal_request_seconds_count{company="stc",endpoint="generate"} 2' in body
+    assert 'portal_request_seconds_bucket{company="stc",endpoint="generate",le="0.25"} 1' in body
+    assert 'portal_first_request_seconds{endpoint="index",worker="other:1"} 0.500000' in body
+
+
+def test_gone_workers_keep_counting_until_dropped(storage, monkeypatch):
+    monkeypatch.setattr(portal, "metrics", portal.Metrics())
+    now = time.time()
+    store_worker("gone:1", other_worker(5, 3), now - 3600)
+    store_worker("expired:1", other_worker(100, 3), now - portal.METRICS_WORKER_TTL - 1)
+
+    body = portal.collect_metrics(now)
+
+    assert 'portal_bills_total{company="stc",result="rendered"} 5' in body
+    assert "gone:1" not in body                         # its gauges are no longer current
+    with portal.get_db() as conn:
+        workers = {row["worker"] for row in conn.execute("SELECT worker FROM metrics")}
+    assert workers == {"gone:1", portal._metrics_worker()}
@@ -0,0 +1,46 @@
+import os
+import signal
+
+import pandas as pd
+from conftest import bill_rows
+
+import app as portal
+
+
+def bill_groups(n_bills):
+    rows = bill_rows([f"FB/{b:04d}" for b in range(n_bills) for _ in range(2)])
+    df = portal.prepare_bills(portal.normalise_dates(pd.DataFrame(rows)), "stc")
+    return portal.iter_bill_groups(df)
+
+
+def test_render_survives_a_killed_pool_process(storage, monkeypatch):
+    monkeypatch.setattr(portal, "PDF_WORKERS", 2)
+    monkeypatch.setattr(portal, "PDF_PARALLEL_MIN_BILLS", 2)
+    monkeypatch.setattr(portal, "_pdf_pool", None)
+    pool = portal.get_pdf_pool()
+    try:
+        os.kill(pool.submit(os.getpid).result(timeout=60), signal.SIGKILL)
+
+        names = [name for name, _ in portal.iter_bill_pdfs(bill_groups(6), "stc", workers=2)]
+
+        assert names == [portal.bill_pdf_name(f"FB/{b:04d}", "stc") for b in range(6)]
+        assert portal._pdf_pool is not pool
+        assert 'portal_pdf_pool_restarts_total{reason="broken"}' in portal.metrics.render()
+    finally:
+        pool.shutdown(wait=False)
+        if portal._pdf_pool is not None:
+            portal._pdf_pool.shutdown()
+
+
+def test_renders_past_the_timeout_are_redone_here(storage, monkeypatch):
+    monkeypatch.setattr(portal, "PDF_WORKERS", 2)
+    monkeypatch.setattr(portal, "PDF_PARALLEL_MIN_BILLS", 2)
+    monkeypatch.setattr(portal, "PDF_RENDER_TIMEOUT", 0)
+    monkeypatch.setattr(portal, "_pdf_pool", None)
+    try:
+        names = [name for name, _ in portal.iter_bill_pdfs(bill_groups(6), "stc", workers=2)]
+        assert names == [portal.bill_pdf_name(f"FB/{b:04d}", "stc") for b in range(6)]
+        assert 'portal_pdf_pool_restarts_total{reason="timeout"}' in portal.metrics.render()
+    finally:
+        if portal._pdf_pool is not None:
+            portal._pdf_pool.shutdown()
@@ -0,0 +1,98 @@
+import io
+import random
+import zipfile
+
+import pytest
+from conftest import bill_rows, sheet_bytes
+
+import app as portal
+
+
+def bill_numbers(n_bills, rows_per_bill):
+    return [f"FB/{b:04d}" for b in range(n_bills) for _ in range(rows_per_bill)]
+
+
+def test_sorted_sheet_streams_in_order(write_sheet):
+    path = write_sheet(bill_rows(bill_numbers(40, 5)))
+    chunks = list(portal.iter_sheet_chunks(path, chunk_rows=50))
+    assert len(chunks) > 1
+    streamed = [b for chunk in chunks for b in chunk['FreightBillNo'].unique()]
+    assert streamed == sorted(streamed)
+    assert sum(len(chunk) for chunk in chunks) == 200
+
+
+def test_no_bill_is_split_across_chunks(write_sheet):
+    path = write_sheet(bill_rows(bill_numbers(7, 30)))
+    seen = set()
+    for chunk in portal.iter_sheet_chunks(path, chunk_rows=50):
+        bills = set(chunk['FreightBillNo'])
+        assert not bills & seen
+        seen |= bills
+
+
+def test_split_bill_fails_once_found(write_sheet):
+    bills = bill_numbers(3, 30) + ["FB/0000"]
+    path = write_sheet(bill_rows(bills))
+    chunks = portal.iter_sheet_chunks(path, chunk_rows=50)
+    next(chunks)                                           # handed out before the sheet is read whole
+    with pytest.raises(ValueError, match="FB/0000.*sort the sheet"):
+        list(chunks)
+
+
+def test_contiguous_but_unsorted_bills_fail_once_found(write_sheet):
+    bills = [f"FB/{b:04d}" for b in (5, 4, 3, 2, 1, 0) for _ in range(20)]
+    path = write_sheet(bill_rows(bills))
+    with pytest.raises(ValueError, match="comes after bill"):
+        list(portal.iter_sheet_chunks(path, chunk_rows=50))
+    # Within one chunk the order does not matter
+    chunks = list(portal.iter_sheet_chunks(path, chunk_rows=1000))
+    assert len(chunks) == 1 and len(chunks[0]) == 120
+
+
+def test_shuffled_upload_within_one_chunk_gives_a_sorted_zip(storage):
+    bills = bill_numbers(40, 5)
+    random.Random(5).shuffle(bills)
+    data = sheet_bytes(bill_rows(bills))
+
+    response = portal.app.test_client().post(
+        "/", data={"company": "stc", "persist": "0", "file": (io.BytesIO(data), "shuffled.xlsx")})
+    body = response.get_data()
+
+    assert response.status_code == 200
+    names = zipfile.ZipFile(io.BytesIO(body)).namelist()
+    assert names == [portal.bill_pdf_name(b, "stc") for b in sorted(set(bills))]
+
+
+def test_sorted_upload_streams_a_complete_zip(storage, monkeypatch):
+    monkeypatch.setattr(portal, "EXCEL_CHUNK_ROWS", 50)
+    bills = bill_numbers(40, 5)
+    data = sheet_bytes(bill_rows(bills))
+
+    response = portal.app.test_client().post(
+        "/", data={"company": "stc", "persist": "0", "file": (io.BytesIO(data), "sorted.xlsx")})
+    body = response.get_data()
+
+    assert response.status_code == 200
+    names = zipfile.ZipFile(io.BytesIO(body)).namelist()
+    assert names == [portal.bill_pdf_name(b, "stc") for b in sorted(set(bills))]
+
+
+def test_parse_stage_counts_one_sample_per_chunk(write_sheet):
+    path = write_sheet(bill_rows(bill_numbers(2, 3)))
+    timer = portal.RequestTimer("test")
+    with timer.active():
+        chunks = list(portal.timed_iter(portal.iter_sheet_chunks(path), "excel_parse"))
+    assert len(chunks) == 1
+    assert timer.stages["excel_parse"][1] == 1
+
+
+def test_unsorted_upload_larger_than_a_chunk_fails_mid_stream(storage, monkeypatch):
+    monkeypatch.setattr(portal, "EXCEL_CHUNK_ROWS", 50)
+    bills = bill_numbers(40, 5)
+    random.Random(5).shuffle(bills)
+    data = sheet_bytes(bill_rows(bills))
+
+    response = portal.app.test_client().post(
+        "/", data={"company": "stc", "persist": "0", "file": (io.BytesIO(data), "shuffled.xlsx")})
+    with pytest.raises(ValueError, match="sort the sheet by FreightBillNo"):
+        response.get_data()
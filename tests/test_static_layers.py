@@ -0,0 +1,54 @@
+import io
+
+import pandas as pd
+import pytest
+import reportlab
+from conftest import bill_rows
+from reportlab.pdfgen import canvas
+
+import app as portal
+
+DRAW_BILL = {"stc": portal.draw_basic_bill, "transin": portal.draw_transin_bill}
+
+
+def render(company_code, rows, monkeypatch, replay):
+    """A bill rendered with deterministic PDF output, the static layers replayed or drawn."""
+    monkeypatch.setattr(portal, "_static_layers", {})
+    if not replay:
+        monkeypatch.setattr(portal, "_replayable", lambda code: False)
+    df = portal.prepare_bills(portal.normalise_dates(pd.DataFrame(rows)), company_code)
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=portal.PAGE_SIZE, invariant=1)
+    DRAW_BILL[company_code](c, df, company_code)
+    c.save()
+    return buf.getvalue(), portal._static_layers
+
+
+@pytest.mark.parametrize("company_code", ["stc", "transin"])
+@pytest.mark.parametrize("row_count", [1, 60])           # one page, and a bill that breaks across pages
+def test_replayed_layers_match_public_drawing(company_code, row_count, monkeypatch):
+    # Run on whatever ReportLab is installed: a pass says its release can
+    # join _REPLAY_REPORTLAB.
+    version = ".".join(reportlab.Version.split(".")[:2])
+    monkeypatch.setattr(portal, "_REPLAY_REPORTLAB", (version,))
+    rows = bill_rows(["FB/1"] * row_count, transin=company_code == "transin")
+    replayed, layers = render(company_code, rows, monkeypatch, replay=True)
+    assert all(layer.code is not None for layer in layers.values())
+    drawn, layers = render(company_code, rows, monkeypatch, replay=False)
+    assert all(layer.code is None for layer in layers.values())
+    assert replayed == drawn
+
+
+def test_layers_using_other_resources_are_not_replayed():
+    assert portal._replayable(["BT /F1 9 Tf 10.8 TL ET", "BT 1 0 0 1 40 400 Tm (a/b Do) Tj T* ET"])
+    assert not portal._replayable(["q 100 0 0 80 55 460 cm /FormXob.1 Do Q"])
+    assert not portal._replayable(["/GS1 gs"])
+
+
+def test_untested_reportlab_release_draws_layers(monkeypatch):
+    monkeypatch.setattr(portal, "_REPLAY_REPORTLAB", ("0.0",))
+    rows = bill_rows(["FB/1"])
+    drawn, layers = render("stc", rows, monkeypatch, replay=True)
+    assert layers and all(layer.code is None for layer in layers.values())
+    monkeypatch.setattr(portal, "_REPLAY_REPORTLAB", (".".join(reportlab.Version.split(".")[:2]),))
+    assert render("stc", rows, monkeypatch, replay=True)[0] == drawn
@@ -0,0 +1,147 @@
+import os
+import time
+
+import pytest
+
+import app as portal
+
+DAY = 86400
+NOW = time.time()
+
+
+def make_bill(bill_no, age, size=1000):
+    """A persisted, indexed bill PDF last written `age` seconds ago; returns its file name."""
+    name = portal.bill_pdf_name(bill_no, "stc")
+    path = os.path.join(portal.OUTPUT_FOLDER, name)
+    for p in (path, path + ".sha256"):
+        with open(p, 'wb') as f:
+            f.write(b"%" * (size if p == path else 10))
+        os.utime(p, (NOW - age, NOW - age))
+    with portal.get_db() as conn:
+        conn.execute("INSERT INTO bills (pdf_file, company_code, bill_no, total, rows, updated) "
+                     "VALUES (?, 'stc', ?, 100, 1, '2025-01-01')", (name, bill_no))
+        conn.execute("INSERT INTO bill_refs (pdf_file, kind, value) VALUES (?, 'lr', ?)", (name, bill_no))
+    return name
+
+
+def add_run(bill_nos, when):
+    entry = portal.make_history_entry("a.xlsx", "stc", len(bill_nos), bill_nos,
+                                      [portal.bill_pdf_name(b, "stc") for b in bill_nos])
+    entry["time"] = when
+    portal.save_history(entry)
+
+
+def exists(name):
+    return os.path.exists(os.path.join(portal.OUTPUT_FOLDER, name))
+
+
+@pytest.fixture
+def janitor(storage, monkeypatch):
+    monkeypatch.setattr(portal, "RETENTION_DAYS", 30)
+    monkeypatch.setattr(portal, "OUTPUT_QUOTA_MB", 1024)
+    monkeypatch.setattr(portal, "HISTORY_PROTECT_RUNS", 1)
+    monkeypatch.setattr(portal, "WORKSPACE_MAX_AGE_HOURS", 6)
+    return monkeypatch
+
+
+def test_retention_evicts_only_old_bills(janitor):
+    old = make_bill("OLD", 40 * DAY)
+    fresh = make_bill("FRESH", 2 * DAY)
+    summary = portal.sweep_storage(NOW)
+    assert summary["evicted"] == 1
+    assert not exists(old) and not exists(old + ".sha256")
+    assert exists(fresh)
+
+
+def test_quota_evicts_least_recently_used_first(janitor):
+    janitor.setattr(portal, "OUTPUT_QUOTA_MB", 0)
+    a = make_bill("A", 5 * DAY, size=1000)
+    b = make_bill("B", 4 * DAY, size=1000)
+    c = make_bill("C", 3 * DAY, size=1000)
+    # A is the oldest file but was downloaded recently, so B is least recently used
+    portal.record_download(os.path.join(portal.OUTPUT_FOLDER, a))
+    with portal.get_db() as conn:
+        conn.execute("UPDATE file_access SET last_access = ?", (NOW - 2 * DAY,))
+    order = []
+    real_forget = portal._forget
+    janitor.setattr(portal, "_forget", lambda conn, item: (order.append(item["key"]), real_forget(conn, item)))
+    portal.sweep_storage(NOW)
+    assert order == [b, c, a]
+
+
+def test_quota_stops_once_under_the_limit(janitor):
+    janitor.setattr(portal, "OUTPUT_QUOTA_MB", 1)
+    old = make_bill("OLD", 5 * DAY, size=600 * 1024)
+    new = make_bill("NEW", 4 * DAY, size=600 * 1024)
+    portal.sweep_storage(NOW)
+    assert not exists(old) and exists(new)
+
+
+def test_newest_history_runs_are_protected(janitor):
+    janitor.setattr(portal, "OUTPUT_QUOTA_MB", 0)
+    kept = make_bill("KEPT", 90 * DAY)
+    gone = make_bill("GONE", 90 * DAY)
+    add_run(["GONE"], "2025-01-01 10:00:00")
+    add_run(["KEPT"], "2025-01-02 10:00:00")
+    portal.sweep_storage(NOW)
+    assert exists(kept) and not exists(gone)
+
+
+def test_files_used_within_the_last_hour_are_kept(janitor):
+    janitor.setattr(portal, "OUTPUT_QUOTA_MB", 0)
+    recent = make_bill("RECENT", 30 * 60)
+    downloaded = make_bill("DOWNLOADED", 90 * DAY)
+    portal.record_download(os.path.join(portal.OUTPUT_FOLDER, downloaded))
+    older = make_bill("OLDER", 2 * 3600)
+    portal.sweep_storage(time.time())
+    assert exists(recent) and exists(downloaded)
+    assert not exists(older)
+
+
+def test_eviction_cleans_index_history_and_jobs(janitor):
+    name = make_bill("OLD", 40 * DAY)
+    add_run(["OLD"], "2025-01-01 10:00:00")
+    add_run(["OTHER"], "2025-01-02 10:00:00")              # newest run, protects nothing on disk
+    job_path = os.path.join(portal.JOBS_FOLDER, "a" * 32 + ".zip")
+    with open(job_path, 'wb') as f:
+        f.write(b"PK")
+    os.utime(job_path, (NOW - 40 * DAY, NOW - 40 * DAY))
+    with portal.get_db() as conn:
+        conn.execute("INSERT INTO jobs (id, status, file, company_code, created, result_path) "
+                     "VALUES (?, 'done', 'a.xlsx', 'stc', '2025-01-01', ?)", ("a" * 32, job_path))
+
+    portal.sweep_storage(NOW)
+
+    with portal.get_db() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM bills").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM bill_refs").fetchone()[0] == 0
+        assert conn.execute("SELECT pdf_file FROM history_bills WHERE bill_no = 'OLD'").fetchone()[0] is None
+        job = conn.execute("SELECT status, result_path FROM jobs").fetchone()
+    assert tuple(job) == ("expired", None)
+    assert not os.path.exists(job_path) and not exists(name)
+    assert portal.search_bills(q="OLD")[1] == 0
+
+
+def test_stale_workspaces_go_but_active_job_workspaces_stay(janitor):
+    def workspace(name, age):
+        path = os.path.join(portal.UPLOAD_FOLDER, name)
+        os.makedirs(path)
+        os.utime(path, (NOW - age, NOW - age))
+        return path
+
+    active_id, done_id = "a" * 32, "b" * 32
+    with portal.get_db() as conn:
+        conn.execute("INSERT INTO jobs (id, status, file, company_code, created) "
+                     "VALUES (?, 'queued', 'a.xlsx', 'stc', '2025-01-01')", (active_id,))
+        conn.execute("INSERT INTO jobs (id, status, file, company_code, created) "
+                     "VALUES (?, 'done', 'a.xlsx', 'stc', '2025-01-01')", (done_id,))
+    stale = workspace("req-x1", 7 * 3600)
+    young = workspace("req-x2", 3600)
+    active = workspace(f"job-{active_id}-x3", 7 * 3600)
+    finished = workspace(f"job-{done_id}-x4", 7 * 3600)
+
+    portal.sweep_storage(NOW)
+
+    assert not os.path.exists(stale) and not os.path.exists(finished)
+    assert os.path.exists(young) and os.path.exists(active)
+    assert os.path.isdir(portal.PARSE_CACHE_FOLDER)
@@ -0,0 +1,41 @@
+import hashlib
+import os
+import time
+
+import app as portal
+
+
+def test_template_last_modified_is_the_source_mtime_in_utc(storage, monkeypatch):
+    monkeypatch.setattr(portal, "_templates", {})
+    client = portal.app.test_client()
+    response = client.get("/download-template?company=stc")
+    assert response.status_code == 200
+    modified = response.last_modified.timestamp()
+    assert modified == int(os.path.getmtime(portal.__file__))
+    assert modified <= time.time()
+
+    again = client.get("/download-template?company=stc",
+                       headers={"If-Modified-Since": response.headers["Last-Modified"]})
+    assert again.status_code == 304
+
+
+def test_rebuilt_template_is_not_dated_in_the_future(storage, monkeypatch):
+    monkeypatch.setattr(portal, "_templates", {"stc": ("stale", "stale", b"", 0)})
+    before = int(time.time())
+    response = portal.app.test_client().get("/download-template?company=stc")
+    assert before <= response.last_modified.timestamp() <= time.time()
+
+
+def test_template_etag_is_the_hash_of_the_bytes_served(storage, monkeypatch):
+    monkeypatch.setattr(portal, "_templates", {})
+    client = portal.app.test_client()
+    response = client.get("/download-template?company=stc")
+    assert response.get_etag()[0] == hashlib.sha256(response.get_data()).hexdigest()[:32]
+
+    # Another build (another worker, a restart) must not answer a resumed
+    # download of this one with a slice of itself.
+    monkeypatch.setattr(portal, "create_excel_template", lambda code: b"another build")
+    monkeypatch.setattr(portal, "_templates", {})
+    resumed = client.get("/download-template?company=stc",
+                         headers={"Range": "bytes=5-", "If-Range": response.headers["ETag"]})
+    assert resumed.status_code == 200 and resumed.get_data() == b"another build"